@@ -0,0 +1,150 @@
+"""
+Benchmark the DB connection profiles against the legacy rollback-journal
+connection on a synthetic DB.
+
+    python benchmarks/db_profiles.py -n 1000000
+
+Reports the time to sync (write) the messages in batches, to read all of
+them in a build pass, and how long a sync's write waits on a concurrent
+build reading the DB.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tgarchive import db as tgdb
+from tgarchive.db import DB, User, Message
+
+# The connection settings before profiles: a rollback journal that's
+# fsynced on every commit.
+tgdb.profiles["legacy"] = ["journal_mode = DELETE", "synchronous = FULL"]
+
+BATCH_SIZE = 500
+NUM_USERS = 1000
+
+
+def make_messages(n):
+    rnd = random.Random(1)
+    users = [
+        User(
+            id=i,
+            username="user{}".format(i),
+            first_name="First{}".format(i),
+            last_name=None,
+            tags=[],
+            avatar=None,
+            full=json.dumps({"id": i, "username": "user{}".format(i)}),
+        )
+        for i in range(1, NUM_USERS + 1)
+    ]
+
+    date = datetime(2018, 1, 1)
+    for i in range(1, n + 1):
+        date += timedelta(seconds=rnd.randint(1, 300))
+        text = " ".join("word{}".format(rnd.randint(1, 5000)) for _ in range(20))
+        yield Message(
+            id=i,
+            type="message",
+            date=date,
+            edit_date=None,
+            content=text,
+            reply_to=i - rnd.randint(1, 50) if i > 50 and i % 5 == 0 else None,
+            user=users[rnd.randrange(NUM_USERS)],
+            media=None,
+            full=json.dumps({"id": i, "message": text, "views": i % 1000}),
+            chat_id=1,
+            from_chat_id=None,
+            from_chat=None,
+        )
+
+
+def bench_write(path, profile, n) -> float:
+    """Time the flush() of all the messages in batches."""
+    db = DB(path, profile=profile)
+    took = 0
+    for i, m in enumerate(make_messages(n), 1):
+        db.buffer_message(m)
+        if i % BATCH_SIZE == 0 or i == n:
+            start = time.monotonic()
+            db.flush()
+            took += time.monotonic() - start
+    db.conn.close()
+    return took
+
+
+def bench_read(path, profile, readonly) -> (float, int):
+    db = DB(path, profile=profile, readonly=readonly)
+    start = time.monotonic()
+    n = sum(1 for _ in db.iter_messages())
+    took = time.monotonic() - start
+    db.conn.close()
+    return took, n
+
+
+def bench_contention(path, profile, n) -> float:
+    """
+    Time a sync's flush() of a batch while a build is reading all the
+    messages in another connection.
+    """
+    writer = DB(path, profile=profile)
+    writer.conn.execute("PRAGMA busy_timeout = 60000")
+
+    started = threading.Event()
+
+    def read():
+        reader = DB(path, profile="build" if profile != "legacy" else "legacy")
+        it = reader.iter_messages()
+        next(it)
+        started.set()
+        for _ in it:
+            pass
+        reader.conn.close()
+
+    t = threading.Thread(target=read)
+    t.start()
+    started.wait()
+
+    for m in make_messages(BATCH_SIZE):
+        writer.buffer_message(m._replace(id=n + m.id))
+
+    start = time.monotonic()
+    writer.flush()
+    took = time.monotonic() - start
+
+    t.join()
+    writer.conn.close()
+    return took
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    p.add_argument("-n", type=int, default=1000000, help="number of messages")
+    p.add_argument("--dir", default=None, help="directory for the test DBs")
+    args = p.parse_args()
+
+    # Don't log every flush.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmp = tempfile.mkdtemp(dir=args.dir)
+    print("{} messages in {}".format(args.n, tmp))
+    print("{:<8} {:>10} {:>10} {:>12}".format("profile", "sync", "build", "contention"))
+
+    for write, read in [("legacy", "legacy"), ("sync", "build")]:
+        path = os.path.join(tmp, "{}.sqlite".format(write))
+        w = bench_write(path, write, args.n)
+        r, _ = bench_read(path, read, read != "legacy")
+        c = bench_contention(path, write, args.n)
+        print("{:<8} {:>9.2f}s {:>9.2f}s {:>11.3f}s".format(write, w, r, c))
+
+
+if __name__ == "__main__":
+    main()
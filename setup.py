@@ -36,6 +36,7 @@ setup(
     url="",
     packages=["tgarchive"],
     install_requires=parse_requirements("requirements.txt"),
+    extras_require={"zstd": ["zstandard"], "brotli": ["brotli"]},
     version=get_version(),
     include_package_data=True,
     download_url="",
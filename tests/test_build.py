@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from tgarchive import _CONFIG
+from tgarchive.build import Build
+from tgarchive.db import DB, Message, User
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "tgarchive", "example")
+
+
+class TestBuild(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.dir.name, "data.sqlite")
+        self.config = {
+            **_CONFIG,
+            "group": ["test"],
+            "timezone": "America/New_York",
+            "per_page": 500,
+            "static_dir": os.path.join(EXAMPLE_DIR, "static"),
+            "media_dir": os.path.join(self.dir.name, "media"),
+            "publish_dir": os.path.join(self.dir.name, "site"),
+            "build_manifest": os.path.join(self.dir.name, "build_manifest.json"),
+            "cache_dir": os.path.join(self.dir.name, "cache"),
+        }
+
+        # A message every hour from the first UTC minute of 2020, which is
+        # still 2019 in New York.
+        db = DB(self.dbfile)
+        user = User(1, "user", "First", None, [], None, json.dumps({"id": 1}))
+        start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        for i in range(1, 24 * 45 + 1):
+            db.buffer_message(
+                Message(
+                    id=i,
+                    type="message",
+                    date=start + timedelta(hours=i - 1),
+                    edit_date=None,
+                    content="message {}".format(i),
+                    reply_to=i - 1 if i % 10 == 0 else None,
+                    user=user,
+                    media=None,
+                    full=json.dumps({"id": i, "from_id": {"user_id": 1}}),
+                    chat_id=1,
+                    from_chat_id=None,
+                    from_chat=None,
+                )
+            )
+        db.flush()
+        db.conn.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def build(self, incremental=False) -> Build:
+        db = DB(self.dbfile, self.config["timezone"], config=self.config)
+        b = Build(self.config, db, False, incremental)
+        b.load_template(os.path.join(EXAMPLE_DIR, "template.html"))
+        b.load_rss_template(os.path.join(EXAMPLE_DIR, "rss_template.html"))
+        b.build()
+        db.conn.close()
+        return b
+
+    def read(self, fname) -> str:
+        with open(os.path.join(self.config["publish_dir"], fname)) as f:
+            return f.read()
+
+    def test_build_timezone(self):
+        b = self.build()
+
+        # Months are UTC months with the local days of their messages.
+        months = [m for ms in b.timeline.values() for m in ms]
+        self.assertEqual([m.slug for m in months], ["2020-01", "2020-02"])
+        self.assertEqual([m.count for m in months], [24 * 31, 24 * 14])
+
+        pages = [f for f in os.listdir(self.config["publish_dir"]) if f.endswith(".html")]
+        self.assertEqual(
+            sorted(pages),
+            ["2020-01.html", "2020-01_2.html", "2020-02.html", "index.html"],
+        )
+        self.assertEqual(
+            json.loads(self.read("timeline.json")),
+            {"2020-01": 24 * 31, "2020-02": 24 * 14},
+        )
+
+        page = self.read("2020-01.html")
+        self.assertIn('id="1:1"', page)
+        self.assertIn("31 December 2019", page)
+        self.assertNotIn('id="1:745"', page)
+        self.assertIn('id="1:745"', self.read("2020-02.html"))
+
+        # Nothing has changed, so nothing is rendered again.
+        with self.assertLogs(level="INFO") as logs:
+            self.build(incremental=True)
+        self.assertIn("rendered 0 pages in 0 of 2 months", "\n".join(logs.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
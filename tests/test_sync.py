@@ -0,0 +1,159 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import telethon.tl.types as types
+
+from tgarchive import _CONFIG
+from tgarchive.db import DB
+from tgarchive.sync import Sync
+
+GROUP_ID = 1000
+
+
+def make_message(id):
+    """Make a fake Telethon message with a photo."""
+    photo = types.Photo(
+        id=id,
+        access_hash=0,
+        file_reference=b"",
+        date=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        sizes=[],
+        dc_id=2,
+    )
+    return SimpleNamespace(
+        id=id,
+        date=datetime(2024, 1, 1, 0, id % 60, tzinfo=timezone.utc),
+        edit_date=None,
+        raw_text="message {}".format(id),
+        reply_to=None,
+        reply_to_msg_id=None,
+        sender=None,
+        action=None,
+        fwd_from=None,
+        media=types.MessageMediaPhoto(photo=photo),
+        photo=photo,
+        document=None,
+        file=SimpleNamespace(size=4, mime_type="image/jpeg", name=None),
+        to_json=lambda: "{}",
+    )
+
+
+class FakeClient:
+    """
+    FakeClient serves messages 1..count from memory. download_media() hangs
+    if hang is set, or takes delay seconds, and get_messages() raises error
+    once the messages after error_after are requested.
+    """
+
+    def __init__(self, count, hang=False, error_after=None, delay=0):
+        self.messages = [make_message(i) for i in range(1, count + 1)]
+        self.hang = hang
+        self.error_after = error_after
+        self.delay = delay
+        self.downloaded = []
+
+    async def get_entity(self, group):
+        return SimpleNamespace(id=group)
+
+    async def get_messages(self, group, offset_id=0, limit=100, ids=None, **kw):
+        if ids:
+            return [m for m in self.messages if m.id in ids]
+        if self.error_after is not None and offset_id >= self.error_after:
+            raise ConnectionError("connection lost")
+        return [m for m in self.messages if m.id > offset_id][:limit]
+
+    async def download_media(self, msg, file):
+        if self.hang:
+            await asyncio.Event().wait()
+        await asyncio.sleep(self.delay)
+        self.downloaded.append(msg.id)
+
+        path = os.path.join(file, "{}.jpg".format(msg.id))
+        with open(path, "wb") as f:
+            f.write(b"test")
+        return path
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {
+            **_CONFIG,
+            "media_dir": os.path.join(self.dir.name, "media"),
+            "fetch_batch_size": 10,
+            "fetch_wait": 0,
+        }
+        self.db = DB(os.path.join(self.dir.name, "data.sqlite"))
+
+    def tearDown(self):
+        self.db.conn.close()
+        self.dir.cleanup()
+
+    def sync(self, client, timeout=5, metadata_only=False):
+        s = Sync(self.config, None, self.db, client)
+        asyncio.run(
+            asyncio.wait_for(
+                s.sync(group=GROUP_ID, metadata_only=metadata_only), timeout
+            )
+        )
+
+    def count(self, query):
+        return self.db.conn.execute(query).fetchone()[0]
+
+    def test_sync(self):
+        self.sync(FakeClient(25))
+        self.assertEqual(self.count("SELECT COUNT(*) FROM messages"), 25)
+        self.assertEqual(
+            self.count("SELECT COUNT(*) FROM media WHERE url IS NOT NULL"), 25
+        )
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), 0)
+
+    def test_fetch_error(self):
+        # The error is raised instead of the sync waiting for messages
+        # forever, and the messages fetched before it are written.
+        with self.assertRaises(ConnectionError):
+            self.sync(FakeClient(25, error_after=10))
+        self.assertEqual(self.count("SELECT COUNT(*) FROM messages"), 10)
+
+    def test_interrupted_media(self):
+        # Downloads that are interrupted stay queued and are resumed
+        # by the next sync.
+        with self.assertRaises(asyncio.TimeoutError):
+            self.sync(FakeClient(20, hang=True), timeout=1)
+        n = self.count("SELECT COUNT(*) FROM messages")
+        self.assertGreater(n, 0)
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), n)
+
+        self.sync(FakeClient(20))
+        self.assertEqual(self.count("SELECT COUNT(*) FROM messages"), 20)
+        self.assertEqual(
+            self.count("SELECT COUNT(*) FROM media WHERE url IS NOT NULL"), 20
+        )
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), 0)
+
+    def test_metadata_only(self):
+        # Media deferred by a metadata-only sync is left to sync_media(),
+        # and doesn't hold up the next sync.
+        self.sync(FakeClient(40), metadata_only=True)
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), 40)
+
+        client = FakeClient(60, delay=0.01)
+        self.sync(client)
+        self.assertEqual(self.count("SELECT COUNT(*) FROM messages"), 60)
+        self.assertEqual(sorted(client.downloaded), list(range(41, 61)))
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), 40)
+
+        s = Sync(self.config, None, self.db, FakeClient(60))
+        asyncio.run(s.sync_media(GROUP_ID))
+        self.assertEqual(
+            self.count("SELECT COUNT(*) FROM media WHERE url IS NOT NULL"), 60
+        )
+        self.assertEqual(self.count("SELECT COUNT(*) FROM media_queue"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
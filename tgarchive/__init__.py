@@ -2,6 +2,7 @@ import argparse
 import logging
 import os
 import shutil
+import sqlite3
 import sys
 import yaml
 
@@ -16,6 +17,7 @@ _CONFIG = {
     "api_hash": os.getenv("API_HASH", ""),
     "group": [],
     "download_avatars": False,
+    "prefetch_avatars": False,
     "avatar_size": [64, 64],
     "download_media": True,
     "media_dir": "media",
@@ -26,16 +28,30 @@ _CONFIG = {
     "fetch_batch_size": 500,
     "fetch_wait": 5,
     "fetch_limit": 0,
+    "sync_concurrency": 8,
+    "media_concurrency": 4,
+    "media_dc_concurrency": 2,
+    "media_retry_attempts": 3,
+    "media_priority_mime_types": [],
     "publish_rss_feed": False,
     "rss_feed_entries": 100,
+    "rss_month_feeds": False,
+    "publish_search_index": False,
     "publish_dir": "site",
+    "build_manifest": "build_manifest.json",
+    "cache_dir": "cache",
+    "precompress": [],
+    "fingerprint_assets": False,
     "site_url": "https://mysite.com",
     "static_dir": "static",
     "telegram_url": "https://t.me/{id}",
     "per_page": 1000,
+    "page_format": "html",
     "show_sender_fullname": False,
     "timezone": "",
     "database_backup_dir": "database_backup",
+    "database_backup_keep": 0,
+    "database_compression": "",
     "site_name": "@{group} (Telegram) archive",
     "site_description": "Archive of @{group} Telegram messages.",
     "meta_description": "@{group} {date} Telegram message archive.",
@@ -88,6 +104,21 @@ def main():
         "-v", "--version", action="store_true", dest="version", help="display version"
     )
 
+    p.add_argument(
+        "--compress",
+        action="store_true",
+        dest="compress",
+        help="re-encode the raw JSON of all rows in the DB with database_compression",
+    )
+    p.add_argument(
+        "--search",
+        action="store",
+        type=str,
+        default=None,
+        dest="search",
+        help="search the contents of the synced messages (SQLite FTS5 query syntax)",
+    )
+
     n = p.add_argument_group("new")
     n.add_argument(
         "-n", "--new", action="store_true", dest="new", help="initialize a new site"
@@ -127,6 +158,27 @@ def main():
         dest="from_id",
         help="sync (or update) messages from this id to the latest",
     )
+    s.add_argument(
+        "--metadata-only",
+        action="store_true",
+        dest="metadata_only",
+        default=False,
+        help="sync messages without downloading media and queue the media for --sync-media",
+    )
+    s.add_argument(
+        "--sync-media",
+        action="store_true",
+        dest="sync_media",
+        help="download the queued media of the synced groups",
+    )
+    s.add_argument(
+        "--budget",
+        action="store",
+        type=int,
+        default=0,
+        dest="budget",
+        help="max megabytes of media to download with --sync-media (0 for no limit)",
+    )
 
     b = p.add_argument_group("build")
     b.add_argument(
@@ -149,6 +201,29 @@ def main():
         dest="rss_template",
         help="path to the rss template file",
     )
+    b.add_argument(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=False,
+        help="only re-render months that have changed since the last build",
+    )
+    b.add_argument(
+        "--per-chat",
+        action="store_true",
+        dest="per_chat",
+        default=False,
+        help="build every synced chat into its own sub-site in publish_dir/<chat_id>",
+    )
+    b.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        dest="workers",
+        help="number of processes to render pages in",
+    )
     b.add_argument(
         "--symlink",
         action="store_true",
@@ -163,6 +238,33 @@ def main():
         print("v{}".format(__version__))
         sys.exit()
 
+    # Re-encode the DB's JSON columns.
+    elif args.compress:
+        cfg = get_config(args.config)
+        logging.info(
+            "encoding the DB with '{}'".format(cfg["database_compression"] or "none")
+        )
+        DB(args.data, config=cfg).recompress()
+
+    # Search the synced messages.
+    elif args.search:
+        cfg = get_config(args.config)
+        db = DB(args.data, cfg["timezone"], config=cfg, profile="build")
+        try:
+            for m, snippet in db.search(args.search):
+                print(
+                    "{} {}:{} @{}: {}".format(
+                        m.date.strftime("%Y-%m-%d %H:%M"),
+                        m.chat_id,
+                        m.id,
+                        m.user.username if m.user else "",
+                        " ".join(snippet.split()),
+                    )
+                )
+        except sqlite3.OperationalError as e:
+            logging.error("invalid search query: {}".format(e))
+            sys.exit(1)
+
     # Setup new site.
     elif args.new:
         exdir = os.path.join(os.path.dirname(__file__), "example")
@@ -212,17 +314,35 @@ def main():
                 args.session,
                 DB(args.data, config=cfg, sync=True),
             )
-            s.init_get_and_save_dialogs()
-            for group in cfg["group"]:
-                s.sync(args.id, args.from_id, group)
+            s.run(args.id, args.from_id, cfg["group"], args.metadata_only)
         except KeyboardInterrupt as e:
             logging.info("sync cancelled manually")
             if cfg.get("use_takeout", False):
-                s.finish_takeout()
+                s.client.loop.run_until_complete(s.finish_takeout())
             sys.exit()
         except:
             raise
 
+    # Download queued media from Telegram.
+    elif args.sync_media:
+        from .sync import Sync
+
+        cfg = get_config(args.config)
+        logging.info(
+            "starting Telegram media sync (concurrency={}, budget={} MB)".format(
+                cfg["media_concurrency"], args.budget
+            )
+        )
+
+        try:
+            s = Sync(cfg, args.session, DB(args.data, config=cfg, profile="sync"))
+            s.run_media(cfg["group"], args.budget * 1024 * 1024)
+        except KeyboardInterrupt as e:
+            logging.info("media sync cancelled manually")
+            if cfg.get("use_takeout", False):
+                s.client.loop.run_until_complete(s.finish_takeout())
+            sys.exit()
+
     # Build static site.
     elif args.build:
         from .build import Build
@@ -230,11 +350,19 @@ def main():
         logging.info("building site")
         config = get_config(args.config)
         b = Build(
-            config, DB(args.data, config["timezone"], config=config), args.symlink
+            config,
+            DB(args.data, config["timezone"], config=config, profile="build"),
+            args.symlink,
+            args.incremental,
+            args.workers,
         )
         b.load_template(args.template)
         if args.rss_template:
             b.load_rss_template(args.rss_template)
-        b.build()
+
+        if args.per_chat:
+            b.build_chats()
+        else:
+            b.build()
 
         logging.info("published to directory '{}'".format(config["publish_dir"]))
@@ -0,0 +1,124 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+
+# File that records the signature of the last backed up DB.
+_LAST_BACKUP = "last_backup"
+
+
+def backup(dbfile, backup_dir, keep=0):
+    """
+    Back up an SQLite DB file to backup_dir/<timestamp>.sqlite.gz.
+
+    The DB is snapshotted with SQLite's online backup API and gzipped in
+    a background thread so that syncing can start right away. The DB is
+    switched to WAL mode first, where the snapshot's read transaction
+    doesn't block the sync's writes and doesn't see them either. Only
+    the latest keep backups are retained (0 keeps all). If no messages,
+    users, media or chats have changed since the last backup, it's
+    skipped.
+
+    Returns the backup thread, or None if the backup was skipped.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+
+    conn = sqlite3.connect(dbfile)
+    try:
+        sig = _get_signature(conn)
+        if sig == _load_signature(backup_dir):
+            logging.info("DB unchanged since the last backup. skipping backup")
+            return None
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+
+    name = datetime.now().isoformat().replace(":", "_").replace(".", "_")
+    snapshot = os.path.join(backup_dir, name + ".sqlite")
+    t = threading.Thread(target=_backup, args=(dbfile, snapshot, backup_dir, sig, keep))
+    t.start()
+    return t
+
+
+def _backup(dbfile, snapshot, backup_dir, sig, keep):
+    """Snapshot the DB on its own connection and compress the snapshot."""
+    src = sqlite3.connect(dbfile)
+    dst = sqlite3.connect(snapshot)
+    try:
+        # Copy all pages in a single step, ie: a single read transaction,
+        # as a step that's interleaved with writes restarts the backup.
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+    _compress(snapshot, backup_dir, sig, keep)
+
+
+def _compress(snapshot, backup_dir, sig, keep):
+    """Gzip a snapshot, record its signature and prune old backups."""
+    tmp = snapshot + ".gz.tmp"
+    with open(snapshot, "rb") as f, gzip.open(tmp, "wb") as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+
+    os.replace(tmp, snapshot + ".gz")
+    os.remove(snapshot)
+    _save_signature(backup_dir, sig)
+    logging.info("backed up DB to {}.gz".format(snapshot))
+
+    if keep > 0:
+        backups = sorted(f for f in os.listdir(backup_dir) if f.endswith(".sqlite.gz"))
+        for f in backups[:-keep]:
+            logging.info("removing old backup {}".format(f))
+            os.remove(os.path.join(backup_dir, f))
+
+
+def _get_signature(conn) -> str:
+    """
+    Get a cheap signature of the synced data in a DB. Replaced (edited)
+    messages get new rowids and downloads fill in media URLs, so both
+    change it. Users and chats are updated in place and are few, so
+    their contents are checksummed.
+    """
+    conn.create_function("CRC32", 1, crc32, deterministic=True)
+
+    h = hashlib.sha1()
+    h.update(str(conn.execute("PRAGMA user_version").fetchone()).encode())
+    for q in [
+        "SELECT COUNT(*), MAX(rowid) FROM messages",
+        "SELECT COUNT(*), MAX(rowid), COUNT(url) FROM media",
+        """SELECT COUNT(*), SUM(CRC32(printf('%d:%s:%s:%s:%s:%s',
+            id, username, first_name, last_name, tags, avatar)) + CRC32(full))
+        FROM users""",
+        """SELECT COUNT(*), SUM(CRC32(printf('%d:%s:%s:%s:%s:%s:%s',
+            id, title, name, username, date, archived, pinned))
+            + CRC32(full_entity))
+        FROM chats""",
+    ]:
+        h.update(str(conn.execute(q).fetchone()).encode())
+    return h.hexdigest()
+
+
+def crc32(s):
+    """CRC32 of a str or bytes value, or 0 for None. Used as an SQL function."""
+    if s is None:
+        return 0
+    return zlib.crc32(s if isinstance(s, bytes) else s.encode("utf8"))
+
+
+def _load_signature(backup_dir) -> str:
+    try:
+        with open(os.path.join(backup_dir, _LAST_BACKUP), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _save_signature(backup_dir, sig):
+    with open(os.path.join(backup_dir, _LAST_BACKUP), "w") as f:
+        f.write(sig)
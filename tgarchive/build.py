@@ -1,46 +1,224 @@
+from array import array
+from bisect import bisect_left
 from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
+import gzip
+import hashlib
+import json
 import logging
 import math
 import os
 import pkg_resources
 import re
 import shutil
+import sqlite3
 import magic
 import pytz
 
-from feedgen.feed import FeedGenerator
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+from jinja2.meta import find_referenced_templates
+from markupsafe import Markup
 
-from .db import User, Message
+from .db import DB, User, Message
+from .feed import FeedWriter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 _NL2BR = re.compile(r"\n\n+")
 
+# Static search index: the number of messages in a chunk of the message
+# list, the length of the term prefixes the terms are sharded by, and the
+# number of characters of a message shown in the results.
+_SEARCH_CHUNK_SIZE = 1000
+_SEARCH_PREFIX_LEN = 2
+_SEARCH_EXCERPT_LEN = 160
+
+# Extensions of the published files that are pre-compressed.
+_COMPRESS_EXTS = (".html", ".xml", ".atom", ".json", ".css", ".js", ".svg")
+
+# Extension of the files written by every precompress format.
+_COMPRESS_FORMATS = {"gzip": ".gz", "brotli": ".br"}
+
+
+class PageIndex:
+    """
+    Compact map of (chat_id, message ID) to the name of the page the message
+    is published on. The IDs of every chat are stored in a sorted array
+    with the position of their page in a parallel array, instead of a dict
+    entry per message.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+        # chat_id => (ids, slots)
+        self.chats = OrderedDict()
+
+    def append(self, chat_id, id, slot):
+        """
+        Add a message. The messages of a chat have to be added
+        in ascending ID order.
+        """
+        if chat_id not in self.chats:
+            self.chats[chat_id] = (array("q"), array("I"))
+
+        ids, slots = self.chats[chat_id]
+        ids.append(id)
+        slots.append(slot)
+
+    def get(self, key, default=None):
+        """
+        Get the page name of a (chat_id, id) key. A bare message ID is looked
+        up in all chats, for templates written for single chat archives.
+        """
+        if isinstance(key, tuple):
+            chat_id, id = key
+            chats = [self.chats[chat_id]] if chat_id in self.chats else []
+        else:
+            id, chats = key, self.chats.values()
+
+        if id is None:
+            return default
+
+        for ids, slots in chats:
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                return self.pages[slots[i]]
+        return default
+
+    def __getitem__(self, key):
+        fname = self.get(key)
+        if fname is None:
+            raise KeyError(key)
+        return fname
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return sum(len(ids) for ids, _ in self.chats.values())
+
+
+class FragmentCache:
+    """
+    FragmentCache stores the rendered HTML of messages in a sidecar SQLite
+    DB, keyed by the chat and message ID and a hash of everything that the
+    message's HTML depends on. Only the latest fragment of a message is kept.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS fragments (
+                chat_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                html TEXT NOT NULL,
+                PRIMARY KEY (chat_id, id)
+            )"""
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys) -> dict:
+        """
+        Get the cached fragments of a list of (chat_id, id, key) and return
+        them by (chat_id, id). Fragments with a different key are stale.
+        """
+        out = {}
+        for chat_id in set(k[0] for k in keys):
+            want = {id: key for c, id, key in keys if c == chat_id}
+            cur = self.conn.execute(
+                "SELECT id, key, html FROM fragments WHERE chat_id = ? AND id IN ({})".format(
+                    ", ".join(["?"] * len(want))
+                ),
+                (chat_id, *want.keys()),
+            )
+            for id, key, html in cur:
+                if want[id] == key:
+                    out[(chat_id, id)] = html
+        return out
+
+    def put_many(self, rows):
+        """Save a list of (chat_id, id, key, html) fragments."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fragments (chat_id, id, key, html) VALUES(?, ?, ?, ?)",
+                rows,
+            )
+
 
 class Build:
     config = {}
     template = None
     db = None
 
-    def __init__(self, config, db, symlink):
+    def __init__(
+        self, config, db, symlink, incremental=False, workers=1, chat_id=None
+    ):
         self.config = config
         self.db = db
         self.symlink = symlink
+        self.incremental = incremental
+
+        # Only build the messages of this chat.
+        self.chat_id = chat_id
+
+        # Number of processes to render pages (and compress files) in.
+        self.workers = workers
+
+        for f in self.config.get("precompress") or []:
+            if f not in _COMPRESS_FORMATS:
+                raise ValueError("unknown precompress format: {}".format(f))
+            if f == "brotli" and not brotli:
+                raise ValueError("precompress brotli requires: pip install brotli")
 
         self.rss_template: Template = None
+        self.template_file = None
+        self.rss_template_file = None
+
+        # Hash of the template sources, used to invalidate the build manifest.
+        self.template_hash = ""
 
         # Map of all message IDs across all months and the slug of the page
         # in which they occur (paginated), used to link replies to their
-        # parent messages that may be on arbitrary pages.
-        self.page_ids = {}
+        # parent messages that may be on arbitrary pages. It is built
+        # for all messages before any page is rendered.
+        self.page_ids = PageIndex([])
         self.timeline = OrderedDict()
 
+        # Chats shown on every page and the chats that have feeds,
+        # fetched once per build.
+        self._chats = None
+        self._feed_chats = None
+
+        # Fingerprinted names of static files by their path.
+        self._assets = {}
+
+        # Template of a single message, if the template includes one,
+        # and the cache of its rendered fragments.
+        self.message_template = None
+        self._fragments = None
+
     def build(self):
-        # (Re)create the output directory.
-        self._create_publish_dir()
+        # (Re)create the output directory. Incremental builds keep the
+        # previously published pages, static files and media in place.
+        self._create_publish_dir(clean=not self.incremental)
 
-        timeline = list(self.db.get_timeline())
+        # Months, days and the page numbers of days for all messages.
+        calendar = list(
+            self.db.get_calendar(self.config["per_page"], self.chat_id)
+        )
+        timeline = [month for month, _ in calendar]
         if len(timeline) == 0:
             logging.info("no data found to publish site")
             quit()
@@ -50,89 +228,467 @@ class Build:
                 self.timeline[month.date.year] = []
             self.timeline[month.date.year].append(month)
 
-        # Queue to store the latest N items to publish in the RSS feed.
-        rss_entries = deque([], self.config["rss_feed_entries"])
-        fname = None
-        for month in timeline:
-            # Get the days + message counts for the month.
-            dayline = OrderedDict()
-            for d in self.db.get_dayline(
-                month.date.year, month.date.month, self.config["per_page"]
-            ):
-                dayline[d.slug] = d
-
-            # Paginate and fetch messages for the month until the end..
-            page = 0
-            last_id = 0
-            total = self.db.get_message_count(month.date.year, month.date.month)
-            total_pages = math.ceil(total / self.config["per_page"])
-
-            while True:
-                messages = list(
-                    self.db.get_messages(
-                        month.date.year,
-                        month.date.month,
-                        last_id,
-                        self.config["per_page"],
-                    )
-                )
+        # Pages that aren't rendered again show the month counts of the
+        # build that rendered them. main.js updates them from this file.
+        self._write_timeline(timeline)
+
+        # Manifest of the pages rendered in the last build. Months whose
+        # messages and render inputs are unchanged are not rendered again.
+        manifest = self._load_manifest() if self.incremental else {}
+        old_compressed = manifest.get("compressed", {})
+        render_hash = self._make_render_hash(timeline)
+        if manifest.get("render_hash") != render_hash:
+            manifest = {}
+        old_months = manifest.get("months", {})
+        new_months = OrderedDict()
 
-                if len(messages) == 0:
-                    break
+        stats = {s.slug: s for s in self.db.get_month_stats(self.chat_id)}
+        self.page_ids = self._make_page_index(timeline)
 
-                last_id = messages[-1].id
+        # Months to render in timeline order, with their position in the
+        # timeline.
+        todo = []
+        for n, (month, days) in enumerate(calendar):
+            st = stats[month.slug]
+            month_hash = self._make_month_hash(st)
 
-                page += 1
-                fname = self.make_filename(month, page)
+            old = old_months.get(month.slug)
+            if old and old["hash"] == month_hash and self._pages_exist(old):
+                new_months[month.slug] = old
+                continue
 
-                # Collect the message ID -> page name for all messages in the set
-                # to link to replies in arbitrary positions across months, paginated pages.
-                for m in messages:
-                    self.page_ids[m.id] = fname
+            new_months[month.slug] = {
+                "hash": month_hash,
+                "first_id": st.first_id,
+                "last_id": st.last_id,
+                "max_edit_date": st.max_edit_date,
+                "pages": [],
+            }
+            todo.append((n, month, days))
 
-                if self.config["publish_rss_feed"]:
-                    rss_entries.extend(messages)
+        rendered = 0
+        rendered_months = 0
+        for month, pages in self._render_months(todo):
+            rendered += len(pages)
+            rendered_months += 1
+            new_months[month.slug]["pages"] = pages
 
-                self._render_page(messages, month, dayline, fname, page, total_pages)
+            # Remove pages of the month that no longer exist.
+            old = old_months.get(month.slug)
+            if old:
+                names = set(p["fname"] for p in pages)
+                for p in old["pages"]:
+                    if p["fname"] not in names:
+                        self._remove_page(p["fname"])
+
+        # Remove pages of months that no longer exist.
+        for slug, old in old_months.items():
+            if slug not in new_months:
+                for p in old["pages"]:
+                    self._remove_page(p["fname"])
+                for ext in [".xml", ".atom"]:
+                    self._remove_page(os.path.join("feeds", "months", slug + ext))
+
+        if self.incremental:
+            logging.info(
+                "rendered {} pages in {} of {} months".format(
+                    rendered, rendered_months, len(timeline)
+                )
+            )
+        if self._fragments:
+            logging.info(
+                "rendered {} messages, {} from the fragment cache".format(
+                    self._fragments.hits + self._fragments.misses, self._fragments.hits
+                )
+            )
 
         # The last page chronologically is the latest page. Make it index.
+        fname = None
+        for m in reversed(new_months.values()):
+            if m["pages"]:
+                fname = m["pages"][-1]["fname"]
+                break
+
         if fname:
+            index = os.path.join(self.config["publish_dir"], "index.html")
+            if os.path.lexists(index):
+                os.remove(index)
+
             if self.symlink:
-                os.symlink(
-                    fname, os.path.join(self.config["publish_dir"], "index.html")
-                )
+                os.symlink(fname, index)
             else:
-                shutil.copy(
-                    os.path.join(self.config["publish_dir"], fname),
-                    os.path.join(self.config["publish_dir"], "index.html"),
-                )
+                shutil.copy(os.path.join(self.config["publish_dir"], fname), index)
 
-        # Generate RSS feeds.
+        # Generate RSS feeds of the latest messages, and of every chat in
+        # a build of all chats.
         if self.config["publish_rss_feed"]:
-            self._build_rss(rss_entries, "index.rss", "index.atom")
+            n = self.config["rss_feed_entries"]
+            self._build_rss(
+                "index", self.db.get_latest_messages(n, self.chat_id), self._site_name()
+            )
+
+            if self.chat_id is None:
+                for chat_id, title in self._get_feed_chats():
+                    self._build_rss(
+                        os.path.join("feeds", "chats", str(chat_id)),
+                        self.db.get_latest_messages(n, chat_id),
+                        "{} - {}".format(self._site_name(), title),
+                    )
+
+        # Generate the static search index if any month has changed.
+        search_hash = None
+        if self.config["publish_search_index"]:
+            search_hash = self._hash(
+                render_hash, *(m["hash"] for m in new_months.values())
+            )
+            if manifest.get("search_hash") == search_hash and os.path.isdir(
+                os.path.join(self.config["publish_dir"], "search")
+            ):
+                logging.info("search index unchanged")
+            else:
+                self._build_search_index()
+
+        # Pre-compress the published files that have changed.
+        compressed = {}
+        if self.config["precompress"]:
+            compressed = self._precompress(old_compressed)
+
+        self._save_manifest(
+            {
+                "render_hash": render_hash,
+                "months": new_months,
+                "search_hash": search_hash,
+                "compressed": compressed,
+            }
+        )
+
+    def build_chats(self):
+        """
+        Build every chat into its own sub-site in publish_dir/<chat_id> with
+        its own timeline, page index, feeds and build manifest. With
+        multiple workers, the chats are built in parallel.
+        """
+        chat_ids = self.db.get_chat_ids()
+        if len(chat_ids) == 0:
+            logging.info("no data found to publish site")
+            quit()
+
+        # (Re)create the output directory that holds the chat sub-sites.
+        pubdir = self.config["publish_dir"]
+        if not self.incremental and os.path.exists(pubdir):
+            shutil.rmtree(pubdir)
+        os.makedirs(pubdir, exist_ok=True)
+
+        jobs = [
+            (
+                self._make_chat_config(chat_id),
+                chat_id,
+                self.db.dbfile,
+                self.symlink,
+                self.incremental,
+                self.template_file,
+                self.rss_template_file,
+            )
+            for chat_id in chat_ids
+        ]
+
+        if self.workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(min(self.workers, len(jobs))) as pool:
+                for chat_id in pool.map(_build_chat, jobs):
+                    logging.info("built chat {}".format(chat_id))
+            return
+
+        for config, chat_id, _, _, _, _, _ in jobs:
+            b = Build(
+                config,
+                self.db,
+                self.symlink,
+                self.incremental,
+                self.workers,
+                chat_id,
+            )
+            b.load_template(self.template_file)
+            if self.rss_template_file:
+                b.load_rss_template(self.rss_template_file)
+            b.build()
+            logging.info("built chat {}".format(chat_id))
+
+    def _make_chat_config(self, chat_id) -> dict:
+        """Config of the sub-site of a chat."""
+        config = dict(self.config)
+        config["publish_dir"] = os.path.join(self.config["publish_dir"], str(chat_id))
+        config["site_url"] = "{}/{}".format(self.config["site_url"], chat_id)
+
+        root, ext = os.path.splitext(self.config["build_manifest"])
+        config["build_manifest"] = "{}.{}{}".format(root, chat_id, ext)
+
+        chat = self.db.get_chat(chat_id)
+        config["group"] = [chat.username if chat and chat.username else str(chat_id)]
+        return config
+
+    def _render_months(self, todo):
+        """
+        Render the given months and yield (month, pages) for each of them
+        in timeline order. With multiple workers, months
+        are rendered in a process pool. Otherwise, consecutive months are
+        read from a single cursor over all messages in (date, id) order.
+        """
+        if self.workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(
+                    self.config,
+                    self.db.dbfile,
+                    self.symlink,
+                    self.template_file,
+                    self.rss_template_file,
+                    self.timeline,
+                    self.page_ids,
+                    self.chat_id,
+                ),
+            ) as pool:
+                jobs = [(month, days) for _, month, days in todo]
+                for (_, month, _), pages in zip(todo, pool.map(_render_month, jobs)):
+                    yield month, pages
+            return
+
+        messages = None
+        last = None
+        for n, month, days in todo:
+            if messages is None or n != last + 1:
+                messages = self.db.iter_messages(
+                    month.date.year, month.date.month, self.chat_id
+                )
+            last = n
+
+            yield month, self._build_month(month, days, messages)
+
+    def _build_month(self, month, days, stream) -> list:
+        """
+        Paginate and render the messages of a month, consuming exactly
+        month.count messages from the message stream, one page at a time.
+        Returns the list of page manifest entries.
+        """
+        dayline = OrderedDict()
+        for d in days:
+            dayline[d.slug] = d
+
+        per_page = self.config["per_page"]
+        total_pages = math.ceil(month.count / per_page)
+
+        # The sidebar is the same on all pages of the month.
+        sidebar = self._render_sidebar(month)
+
+        # The latest messages of the month for its feed.
+        feed_entries = None
+        if self.config["publish_rss_feed"] and self.config["rss_month_feeds"]:
+            feed_entries = deque([], self.config["rss_feed_entries"])
+
+        pages = []
+        for page in range(1, total_pages + 1):
+            # The last page of the month gets the remaining messages.
+            size = min(per_page, month.count - (page - 1) * per_page)
+            messages = list(islice(stream, size))
+            if len(messages) == 0:
+                break
+
+            fname = self.make_filename(month, page)
+            self._render_page(
+                messages, month, dayline, fname, page, total_pages, sidebar
+            )
+            if feed_entries is not None:
+                feed_entries.extend(messages)
+
+            edit_dates = [m.edit_date for m in messages if m.edit_date]
+            pages.append(
+                {
+                    "fname": fname,
+                    "first_id": messages[0].id,
+                    "last_id": messages[-1].id,
+                    "count": len(messages),
+                    "max_edit_date": max(edit_dates).isoformat()
+                    if edit_dates
+                    else None,
+                }
+            )
+
+        if feed_entries is not None:
+            self._build_rss(
+                os.path.join("feeds", "months", month.slug),
+                reversed(feed_entries),
+                "{} - {}".format(self._site_name(), month.label),
+            )
+
+        return pages
+
+    def _make_page_index(self, timeline) -> PageIndex:
+        """
+        Build the index of the pages of all messages with one query before
+        rendering, so that replies link to parent messages on any page,
+        including later ones.
+        """
+        per_page = self.config["per_page"]
+
+        # Page names in timeline order and the slot of the first page
+        # of every month.
+        pages, offsets = [], []
+        for month in timeline:
+            offsets.append(len(pages))
+            for page in range(1, math.ceil(month.count / per_page) + 1):
+                pages.append(self.make_filename(month, page))
+
+        index = PageIndex(pages)
+        for chat_id, id, month, page in self.db.get_page_index(
+            per_page, self.chat_id
+        ):
+            index.append(chat_id, id, offsets[month - 1] + page - 1)
+
+        return index
 
     def load_template(self, fname):
-        with open(fname, "r") as f:
-            self.template = Template(
-                f.read(),
-                autoescape=True,
+        self.template, refs = self._load_template(fname)
+        self.template_file = fname
+
+        # Messages rendered by the message.html partial are cached.
+        if "message.html" in refs:
+            self.message_template = self.template.environment.get_template(
+                "message.html"
             )
 
     def load_rss_template(self, fname):
-        with open(fname, "r") as f:
-            self.rss_template = Template(
-                f.read(),
-                autoescape=True,
-            )
+        self.rss_template, _ = self._load_template(fname)
+        self.rss_template_file = fname
+
+    def _load_template(self, fname) -> (Template, set):
+        """
+        Load a template from its directory, so that it can include or
+        extend other templates there, eg: message.html. Compiled templates
+        are cached in cache_dir and reused until their source changes.
+        Returns the template and the names of all templates it references.
+        """
+        env = Environment(
+            loader=FileSystemLoader(os.path.dirname(os.path.abspath(fname))),
+            autoescape=True,
+        )
+        if self.config.get("cache_dir"):
+            cache_dir = os.path.join(self.config["cache_dir"], "templates")
+            os.makedirs(cache_dir, exist_ok=True)
+            env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+        # Hash the sources of the template and all the templates it
+        # references to invalidate the build manifest when any changes.
+        name = os.path.basename(fname)
+        seen = set()
+        todo = [name]
+        while todo:
+            n = todo.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+
+            src = env.loader.get_source(env, n)[0]
+            self.template_hash = self._hash(self.template_hash, src)
+            todo.extend(t for t in find_referenced_templates(env.parse(src)) if t)
+
+        return env.get_template(name), seen
 
     def make_filename(self, month, page) -> str:
         fname = "{}{}.html".format(month.slug, "_" + str(page) if page > 1 else "")
         return fname
 
-    def _render_page(self, messages, month, dayline, fname, page, total_pages):
-        chats = list(self.db.get_groups(self.config["group"]))
+    def asset(self, path) -> str:
+        """
+        Template helper that gets the URL of a static file, eg:
+        asset("static/style.css"). With fingerprint_assets, the file is
+        copied to assets/ with the hash of its contents in its name, so
+        that it can be cached forever. The URL changes with the file.
+        """
+        if not self.config["fingerprint_assets"]:
+            return path
+
+        if path not in self._assets:
+            pubdir = self.config["publish_dir"]
+            with open(os.path.join(pubdir, path), "rb") as f:
+                data = f.read()
+
+            root, ext = os.path.splitext(os.path.basename(path))
+            name = "assets/{}.{}{}".format(
+                root, hashlib.sha1(data).hexdigest()[:10], ext
+            )
+            target = os.path.join(pubdir, name)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+
+                # Render processes may write the same file at the same time.
+                tmp = "{}.{}.tmp".format(target, os.getpid())
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, target)
+
+            self._assets[path] = name
+        return self._assets[path]
+
+    def _get_chats(self) -> list:
+        if self._chats is None:
+            if self.chat_id:
+                self._chats = [c for c in [self.db.get_chat(self.chat_id)] if c]
+            else:
+                self._chats = list(self.db.get_groups(self.config["group"]))
+        return self._chats
+
+    def _render_sidebar(self, month) -> Markup:
+        """
+        Pre-render the template's sidebar block with the chats and the
+        timeline navigation, which are the same on all pages of a month.
+        Returns None if the template has no sidebar block.
+        """
+        if "sidebar" not in self.template.blocks:
+            return None
+
+        ctx = self.template.new_context(
+            {
+                "chats": self._get_chats(),
+                "config": self.config,
+                "timeline": self.timeline,
+                "month": month,
+                "asset": self.asset,
+            }
+        )
+        return Markup("".join(self.template.blocks["sidebar"](ctx)))
+
+    def _render_page(
+        self, messages, month, dayline, fname, page, total_pages, sidebar=None
+    ):
+        # With the json page format, the messages are written to a JSON file
+        # next to the page, which is only a shell that main.js renders them in.
+        page_data = None
+        if self.config["page_format"] == "json":
+            page_data = os.path.splitext(fname)[0] + ".json"
+            with open(
+                os.path.join(self.config["publish_dir"], page_data), "w", encoding="utf8"
+            ) as f:
+                json.dump(
+                    self._make_page_data(messages, dayline),
+                    f,
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                )
+            messages = []
+
+        render_message = None
+        if messages and self.message_template and self.config.get("cache_dir"):
+            fragments = self._render_messages(messages)
+
+            def render_message(m):
+                return fragments[(m.chat_id, m.id)]
+
         html = self.template.render(
-            chats=chats,
+            chats=self._get_chats(),
+            sidebar_html=sidebar,
+            render_message=render_message,
+            page_data=page_data,
+            feeds=self._get_feeds(month),
             config=self.config,
             timeline=self.timeline,
             dayline=dayline,
@@ -144,6 +700,7 @@ class Build:
                 "total": total_pages,
             },
             make_filename=self.make_filename,
+            asset=self.asset,
             nl2br=self._nl2br,
             format_date=self._format_date,
         )
@@ -153,52 +710,406 @@ class Build:
         ) as f:
             f.write(html)
 
-    def _build_rss(self, messages, rss_file, atom_file):
-        f = FeedGenerator()
-        f.id(self.config["site_url"])
-        f.generator(
-            "tg-archive {}".format(pkg_resources.get_distribution("tg-archive").version)
-        )
-        f.link(href=self.config["site_url"], rel="alternate")
-        f.title(self.config["site_name"].format(group=",".join(self.config["group"])))
-        f.subtitle(self.config["site_description"])
-
+    def _make_page_data(self, messages, dayline) -> dict:
+        """
+        Make the data of a page for client-side rendering: its messages
+        with the users and media they refer to, each included only once,
+        and the fields of the raw message JSON that the page shows.
+        """
+        users, media, days, out = {}, {}, {}, []
         for m in messages:
-            url = "{}/{}#{}".format(self.config["site_url"], self.page_ids[m.id], m.id)
-            e = f.add_entry()
-            e.id(url)
-            e.title("@{} on {} (#{})".format(m.user.username, m.date, m.id))
-            e.link({"href": url})
-            e.published(m.date)
-
-            media_mime = ""
-            if m.media and m.media.url:
-                murl = "{}/{}/{}".format(
-                    self.config["site_url"],
-                    os.path.basename(self.config["media_dir"]),
-                    m.media.url,
+            full = m.full or {}
+
+            if m.user and m.user.id not in users:
+                users[m.user.id] = {
+                    "username": m.user.username,
+                    "first_name": m.user.first_name,
+                    "last_name": m.user.last_name,
+                    "tags": m.user.tags.split() if m.user.tags else [],
+                    "avatar": m.user.avatar,
+                }
+
+            if m.media and m.media.id not in media:
+                media[m.media.id] = _compact(
+                    {
+                        "type": m.media.type,
+                        "url": m.media.url,
+                        "title": m.media.title,
+                        "description": m.media.description,
+                        "thumb": m.media.thumb,
+                        "site_name": _get(full, "media", "webpage", "site_name"),
+                    }
+                )
+
+            day = m.date.strftime("%Y-%m-%d")
+            if day not in days:
+                days[day] = {
+                    "title": m.date.strftime("%d %B %Y"),
+                    "count": dayline[day].count if day in dayline else 0,
+                }
+
+            fwd = None
+            if _get(full, "fwd_from", "from_id"):
+                fwd = _compact(
+                    {
+                        "title": _get(m.from_chat, "title"),
+                        "username": _get(m.from_chat, "username"),
+                        "channel_id": _get(full, "fwd_from", "from_id", "channel_id"),
+                        "post": _get(full, "fwd_from", "channel_post"),
+                        "date": self._format_date(full["fwd_from"]["date"])
+                        if _get(full, "fwd_from", "date")
+                        else None,
+                    }
                 )
-                media_path = "{}/{}".format(self.config["media_dir"], m.media.url)
-                media_mime = "application/octet-stream"
-                media_size = 0
-
-                if "://" in media_path:
-                    media_mime = "text/html"
-                else:
-                    try:
-                        media_size = str(os.path.getsize(media_path))
-                        try:
-                            media_mime = magic.from_file(media_path, mime=True)
-                        except:
-                            pass
-                    except FileNotFoundError:
-                        pass
-
-                e.enclosure(murl, media_size, media_mime)
-            e.content(self._make_abstract(m, media_mime), type="html")
-
-        f.rss_file(os.path.join(self.config["publish_dir"], "index.xml"), pretty=True)
-        f.atom_file(os.path.join(self.config["publish_dir"], "index.atom"), pretty=True)
+
+            action = _get(full, "action")
+            out.append(
+                _compact(
+                    {
+                        "id": m.id,
+                        "chat_id": m.chat_id,
+                        "type": m.type,
+                        "day": day,
+                        "date": self._format_date(m.date),
+                        "content": m.content,
+                        "raw": str(full) if not m.content else None,
+                        "user": m.user.id if m.user else None,
+                        "owner": bool(m.user)
+                        and m.user.id == _get(full, "from_id", "user_id"),
+                        "from_user_id": _get(full, "from_id", "user_id"),
+                        "reply_to": m.reply_to,
+                        "reply_page": self.page_ids.get((m.chat_id, m.reply_to))
+                        if m.reply_to
+                        else None,
+                        "media": m.media.id if m.media else None,
+                        "fwd": fwd,
+                        "action": _compact(
+                            {
+                                "_": action.get("_"),
+                                "users": action.get("users"),
+                                "user_id": action.get("user_id"),
+                            }
+                        )
+                        if action
+                        else None,
+                        "edit_date": self._format_date(full["edit_date"])
+                        if _get(full, "edit_date")
+                        else None,
+                        "views": _get(full, "views"),
+                        "replies": _get(full, "replies", "replies_pts"),
+                    }
+                )
+            )
+
+        return {
+            "config": {
+                "telegram_url": self.config["telegram_url"],
+                "show_sender_fullname": self.config["show_sender_fullname"],
+            },
+            "users": users,
+            "media": media,
+            "days": days,
+            "messages": out,
+        }
+
+    def _render_messages(self, messages) -> dict:
+        """
+        Render the messages of a page with the message template, reusing
+        the fragments cached by previous builds. Returns the HTML of the
+        messages by (chat_id, id).
+        """
+        if self._fragments is None:
+            os.makedirs(self.config["cache_dir"], exist_ok=True)
+            self._fragments = FragmentCache(
+                os.path.join(self.config["cache_dir"], "fragments.sqlite")
+            )
+            self._fragment_hash = self._hash(
+                self.template_hash, json.dumps(self.config, sort_keys=True, default=str)
+            )
+
+        keys = [(m.chat_id, m.id, self._make_fragment_key(m)) for m in messages]
+        out = self._fragments.get_many(keys)
+        self._fragments.hits += len(out)
+
+        rows = []
+        for m, (chat_id, id, key) in zip(messages, keys):
+            if (chat_id, id) in out:
+                continue
+
+            html = self.message_template.render(
+                m=m,
+                config=self.config,
+                page_ids=self.page_ids,
+                nl2br=self._nl2br,
+                format_date=self._format_date,
+            )
+            out[(chat_id, id)] = html
+            rows.append((chat_id, id, key, html))
+
+        if rows:
+            self._fragments.put_many(rows)
+            self._fragments.misses += len(rows)
+
+        return {k: Markup(v) for k, v in out.items()}
+
+    def _make_fragment_key(self, m) -> str:
+        """
+        Hash everything that the HTML of a message depends on: the
+        templates and config, the message and its user, media and
+        forwarded-from chat, and the page of the message it replies to.
+        """
+        u, med = m.user, m.media
+        return self._hash(
+            self._fragment_hash,
+            m.date,
+            m.edit_date,
+            m.type,
+            m.content,
+            m.full.raw if m.full else None,
+            (u.id, u.username, u.first_name, u.last_name, u.tags, u.avatar),
+            (med.type, med.url, med.title, med.description, med.thumb, med.full.raw)
+            if med and med.full
+            else med,
+            m.from_chat.raw if m.from_chat else None,
+            self.page_ids.get((m.chat_id, m.reply_to)) if m.reply_to else None,
+        )
+
+    def _build_rss(self, name, messages, title):
+        """
+        Write the RSS and Atom feeds publish_dir/<name>.xml and .atom of
+        the given messages, newest first, as they're streamed.
+        """
+        path = os.path.join(self.config["publish_dir"], name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with FeedWriter(
+            path + ".xml",
+            path + ".atom",
+            url=self.config["site_url"],
+            title=title,
+            description=self.config["site_description"],
+            generator="tg-archive {}".format(
+                pkg_resources.get_distribution("tg-archive").version
+            ),
+        ) as f:
+            for m in messages:
+                self._add_feed_entry(f, m)
+
+    def _add_feed_entry(self, f, m):
+        """Add a message to a feed with its abstract and media enclosure."""
+        url = "{}/{}#{}".format(
+            self.config["site_url"], self.page_ids[(m.chat_id, m.id)], m.id
+        )
+
+        media_mime, enclosure = "", None
+        if m.media and m.media.url:
+            murl = "{}/{}/{}".format(
+                self.config["site_url"],
+                os.path.basename(self.config["media_dir"]),
+                m.media.url,
+            )
+            if "://" in m.media.url:
+                media_mime, media_size = "text/html", 0
+            else:
+                media_mime, media_size = self._get_media_meta(m.media)
+            enclosure = (murl, media_size, media_mime)
+
+        f.add(
+            url,
+            "@{} on {} (#{})".format(m.user.username, m.date, m.id),
+            m.date,
+            self._make_abstract(m, media_mime),
+            enclosure,
+        )
+
+    def _get_feeds(self, month) -> list:
+        """
+        Get the (title, href) of the chat and month feeds to link from the
+        pages of a month, besides the site's index feed.
+        """
+        if not self.config["publish_rss_feed"]:
+            return []
+
+        feeds = []
+        if self.chat_id is None:
+            for chat_id, title in self._get_feed_chats():
+                feeds.append((title, "feeds/chats/{}.xml".format(chat_id)))
+        if self.config["rss_month_feeds"]:
+            feeds.append((month.label, "feeds/months/{}.xml".format(month.slug)))
+        return feeds
+
+    def _get_feed_chats(self) -> list:
+        """Get the (chat_id, title) of the chats that have feeds."""
+        if self._feed_chats is None:
+            self._feed_chats = []
+            for chat_id in self.db.get_chat_ids():
+                chat = self.db.get_chat(chat_id)
+                title = (chat.title or chat.name) if chat else None
+                self._feed_chats.append((chat_id, title or str(chat_id)))
+        return self._feed_chats
+
+    def _site_name(self) -> str:
+        return self.config["site_name"].format(group=",".join(self.config["group"]))
+
+    def _get_media_meta(self, media) -> (str, int):
+        """
+        Get the mime type and size of a downloaded media file. They're
+        stored in the DB when the file is downloaded. Files downloaded
+        before that are read once and their metadata stored in the DB.
+        """
+        if media.mime:
+            return media.mime, media.size or 0
+
+        mime, size = "application/octet-stream", 0
+        path = media.url
+        if not os.path.isfile(path):
+            path = os.path.join(self.config["media_dir"], media.url)
+
+        try:
+            size = os.path.getsize(path)
+            try:
+                mime = magic.from_file(path, mime=True)
+            except:
+                pass
+        except FileNotFoundError:
+            return mime, size
+
+        if not self.db.readonly:
+            self.db.update_media_meta(media.id, mime, size)
+        return mime, size
+
+    def _build_search_index(self):
+        """
+        Write the static search index of the site's client-side search to
+        publish_dir/search. Messages are numbered in (date, id) order and
+        their page, anchor, date and an excerpt are written in chunks of
+        _SEARCH_CHUNK_SIZE to d/<n>.json. The numbers of the messages that
+        every term of the FTS index occurs in are sharded by the term's
+        prefix into t/<hex of the prefix>.json, so that a query only
+        loads the shards of its terms and the chunks of its results.
+        """
+        outdir = os.path.join(self.config["publish_dir"], "search")
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(os.path.join(outdir, "d"))
+        os.makedirs(os.path.join(outdir, "t"))
+
+        # rowid => message number.
+        docs = {}
+        chunk, n = [], 0
+        for rowid, chat_id, id, date, content in self.db.get_search_docs(
+            self.chat_id
+        ):
+            docs[rowid] = len(docs)
+            chunk.append(
+                [
+                    self.page_ids[(chat_id, id)],
+                    "{}:{}".format(chat_id, id),
+                    self._format_date(date),
+                    content[:_SEARCH_EXCERPT_LEN],
+                ]
+            )
+            if len(chunk) == _SEARCH_CHUNK_SIZE:
+                self._write_search_file(outdir, "d", n, chunk)
+                n, chunk = n + 1, []
+        if chunk:
+            self._write_search_file(outdir, "d", n, chunk)
+
+        # Terms are in order, so the terms of a prefix are consecutive.
+        shard, terms, shards = None, {}, 0
+        for term, rowid in self.db.get_search_terms():
+            if rowid not in docs:
+                continue
+
+            prefix = term[:_SEARCH_PREFIX_LEN].encode("utf8").hex()
+            if prefix != shard:
+                if terms:
+                    self._write_shard(outdir, shard, terms)
+                    shards += 1
+                shard, terms = prefix, {}
+
+            if term not in terms:
+                terms[term] = []
+            terms[term].append(docs[rowid])
+
+        if terms:
+            self._write_shard(outdir, shard, terms)
+            shards += 1
+
+        with open(os.path.join(outdir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "docs": len(docs),
+                    "chunk": _SEARCH_CHUNK_SIZE,
+                    "prefix": _SEARCH_PREFIX_LEN,
+                },
+                f,
+            )
+        logging.info(
+            "wrote search index of {} messages in {} shards".format(len(docs), shards)
+        )
+
+    def _write_shard(self, outdir, prefix, terms):
+        # Message numbers are not in rowid order.
+        for ids in terms.values():
+            ids.sort()
+        self._write_search_file(outdir, "t", prefix, terms)
+
+    def _write_search_file(self, outdir, sub, name, data):
+        with open(
+            os.path.join(outdir, sub, "{}.json".format(name)), "w", encoding="utf8"
+        ) as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    def _precompress(self, old_hashes) -> dict:
+        """
+        Write the precompress formats (.gz, .br) of the published text files
+        next to them, for web servers to serve as they are. Files whose
+        hash is the same as in the last build and whose compressed files
+        exist are skipped. Symlinked files and directories (static files
+        and media) are not compressed. Returns the hashes of the files by
+        their path relative to publish_dir.
+        """
+        pubdir = self.config["publish_dir"]
+        exts = [_COMPRESS_FORMATS[f] for f in self.config["precompress"]]
+
+        jobs, links = [], []
+        for root, dirs, files in os.walk(pubdir):
+            for f in files:
+                path = os.path.join(root, f)
+                if not f.endswith(_COMPRESS_EXTS):
+                    continue
+                if os.path.islink(path):
+                    links.append(path)
+                    continue
+
+                name = os.path.relpath(path, pubdir)
+                jobs.append((path, old_hashes.get(name), exts))
+
+        if self.workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                results = list(pool.map(_compress_file, jobs, chunksize=16))
+        else:
+            results = [_compress_file(j) for j in jobs]
+
+        hashes = {}
+        n = 0
+        for path, h, done in results:
+            hashes[os.path.relpath(path, pubdir)] = h
+            n += done
+
+        # Link the compressed files of symlinked pages (index.html) to the
+        # compressed files of their targets.
+        for path in links:
+            target = os.readlink(path)
+            for ext in exts:
+                if os.path.lexists(path + ext):
+                    os.remove(path + ext)
+                if os.path.exists(os.path.join(os.path.dirname(path), target + ext)):
+                    os.symlink(target + ext, path + ext)
+
+        logging.info("compressed {} of {} files".format(n, len(jobs)))
+        return hashes
 
     def _make_abstract(self, m, media_mime):
         if self.rss_template:
@@ -230,19 +1141,99 @@ class Build:
             return mdate.astimezone(pytz.timezone(tz)).strftime("%H:%M %d.%m.%y")
         return mdate.strftime("%H:%M %d.%m.%y")
 
-    def _create_publish_dir(self):
+    def _hash(self, *values) -> str:
+        h = hashlib.sha1()
+        for v in values:
+            h.update(str(v).encode("utf8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _make_render_hash(self, timeline) -> str:
+        """
+        Hash of the inputs shared by all pages: the templates, the config,
+        the list of months in the timeline navigation and the static files
+        if their fingerprinted names are linked from the pages.
+        """
+        return self._hash(
+            self.template_hash,
+            json.dumps(self.config, sort_keys=True, default=str),
+            ",".join(m.slug for m in timeline),
+            self._hash_static() if self.config["fingerprint_assets"] else "",
+        )
+
+    def _hash_static(self) -> str:
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(self.config["static_dir"]):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                h.update(path.encode("utf8"))
+                with open(path, "rb") as fp:
+                    h.update(fp.read())
+        return h.hexdigest()
+
+    def _make_month_hash(self, stats) -> str:
+        return self._hash(*stats)
+
+    def _pages_exist(self, month) -> bool:
+        pubdir = self.config["publish_dir"]
+        for p in month["pages"]:
+            files = [p["fname"]]
+            # Pages of the json page format are empty without their data.
+            if self.config["page_format"] == "json":
+                files.append(os.path.splitext(p["fname"])[0] + ".json")
+
+            for f in files:
+                if not os.path.isfile(os.path.join(pubdir, f)):
+                    return False
+        return True
+
+    def _remove_page(self, fname):
+        # Pages of the json page format have their data next to them.
+        for f in [fname, os.path.splitext(fname)[0] + ".json"]:
+            for ext in [""] + list(_COMPRESS_FORMATS.values()):
+                path = os.path.join(self.config["publish_dir"], f + ext)
+                if os.path.lexists(path):
+                    os.remove(path)
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.config["build_manifest"], "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning("ignoring invalid build manifest: {}".format(e))
+            return {}
+
+    def _write_timeline(self, timeline):
+        """Write the message counts of all months to publish_dir/timeline.json."""
+        fname = os.path.join(self.config["publish_dir"], "timeline.json")
+        with open(fname + ".tmp", "w") as f:
+            json.dump({m.slug: m.count for m in timeline}, f)
+        os.replace(fname + ".tmp", fname)
+
+    def _save_manifest(self, manifest):
+        fname = self.config["build_manifest"]
+        with open(fname + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(fname + ".tmp", fname)
+
+    def _create_publish_dir(self, clean=True):
         pubdir = self.config["publish_dir"]
 
         # Clear the output directory.
-        if os.path.exists(pubdir):
+        if clean and os.path.exists(pubdir):
             shutil.rmtree(pubdir)
 
         # Re-create the output directory.
-        os.mkdir(pubdir)
+        os.makedirs(pubdir, exist_ok=True)
 
         # Copy the static directory into the output directory.
         for f in [self.config["static_dir"]]:
             target = os.path.join(pubdir, f)
+            if os.path.lexists(target):
+                continue
             if self.symlink:
                 self._relative_symlink(os.path.abspath(f), target)
             elif os.path.isfile(f):
@@ -252,7 +1243,9 @@ class Build:
 
         # If media downloading is enabled, copy/symlink the media directory.
         mediadir = self.config["media_dir"]
-        if os.path.exists(mediadir):
+        if os.path.exists(mediadir) and not os.path.lexists(
+            os.path.join(pubdir, os.path.basename(mediadir))
+        ):
             if self.symlink:
                 self._relative_symlink(
                     os.path.abspath(mediadir),
@@ -268,3 +1261,91 @@ class Build:
         src = os.path.relpath(src, dir_path)
         dst = os.path.join(dir_path, os.path.basename(src))
         return os.symlink(src, dst)
+
+
+def _compress_file(job) -> (str, str, bool):
+    """
+    Compress a file to the given extensions (.gz, .br) unless its hash is
+    old_hash and the compressed files exist. Returns the file's path, its
+    hash and whether it was compressed.
+    """
+    path, old_hash, exts = job
+    with open(path, "rb") as f:
+        data = f.read()
+
+    h = hashlib.sha1(data).hexdigest()
+    if h == old_hash and all(os.path.exists(path + e) for e in exts):
+        return path, h, False
+
+    for e in exts:
+        if e == ".gz":
+            out = gzip.compress(data, 9, mtime=0)
+        else:
+            out = brotli.compress(data, quality=11)
+
+        with open(path + e + ".tmp", "wb") as f:
+            f.write(out)
+        os.replace(path + e + ".tmp", path + e)
+
+    return path, h, True
+
+
+def _get(d, *keys):
+    """Get a nested value of raw message JSON, or None if any key is missing."""
+    for k in keys:
+        if not isinstance(d, Mapping):
+            return None
+        d = d.get(k)
+    return d
+
+
+def _compact(d) -> dict:
+    """Drop the empty (None or False) fields of a dict to publish."""
+    return {k: v for k, v in d.items() if v is not None and v is not False}
+
+
+# Build instance of a --workers render process, set up by _init_worker().
+_worker = None
+
+
+def _init_worker(
+    config, dbfile, symlink, template, rss_template, timeline, page_ids, chat_id
+):
+    """
+    Initialize a render process with its own read-only DB connection and
+    compiled templates.
+    """
+    global _worker
+
+    db = DB(dbfile, config["timezone"], config=config, readonly=True)
+    _worker = Build(config, db, symlink, chat_id=chat_id)
+    _worker.load_template(template)
+    if rss_template:
+        _worker.load_rss_template(rss_template)
+
+    _worker.timeline = timeline
+    _worker.page_ids = page_ids
+
+
+def _build_chat(job):
+    """Build the sub-site of a chat in a worker process."""
+    config, chat_id, dbfile, symlink, incremental, template, rss_template = job
+
+    db = DB(dbfile, config["timezone"], config=config, readonly=True)
+    b = Build(config, db, symlink, incremental, chat_id=chat_id)
+    b.load_template(template)
+    if rss_template:
+        b.load_rss_template(rss_template)
+    b.build()
+
+    return chat_id
+
+
+def _render_month(job):
+    """Render a month in a worker process."""
+    month, days = job
+
+    messages = _worker.db.iter_messages(
+        month.date.year, month.date.month, _worker.chat_id
+    )
+    return _worker._build_month(month, days, messages)
@@ -0,0 +1,93 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded values are stored as BLOBs prefixed with the byte of their
+# codec. Plain JSON is stored as TEXT.
+_ZLIB = 1
+_ZSTD = 2
+
+CODECS = ["", "zlib", "zstd"]
+
+# zstd dictionary size and compression level.
+ZSTD_DICT_SIZE = 112640
+ZSTD_LEVEL = 9
+
+
+class Codec:
+    """
+    Codec compresses the raw JSON `full` columns of rows with zlib, or
+    zstd (with an optional trained dictionary) if the zstandard package
+    is installed. Values are decoded by their prefix, so a DB can contain
+    rows of any codec.
+    """
+
+    def __init__(self, name="", dicts=None):
+        if name not in CODECS:
+            raise ValueError("unknown database_compression: {}".format(name))
+        if name == "zstd" and not zstandard:
+            raise ValueError(
+                "database_compression zstd requires: pip install zstandard"
+            )
+
+        self.name = name
+
+        # Data of the zstd dictionaries by their ID, in the order they were
+        # trained. The last one is used for compressing. They're only loaded
+        # when zstd is used, as zstandard may not be installed.
+        self._dicts = dict(dicts or {})
+        self._decompressors = {}
+        self._compressor = None
+
+        if name == "zstd":
+            d = None
+            if self._dicts:
+                d = zstandard.ZstdCompressionDict(list(self._dicts.values())[-1])
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=d)
+
+    def encode(self, s):
+        """Encode a JSON string with the codec."""
+        if s is None or not self.name:
+            return s
+
+        b = s.encode("utf8")
+        if self.name == "zlib":
+            return bytes([_ZLIB]) + zlib.compress(b)
+        return bytes([_ZSTD]) + self._compressor.compress(b)
+
+    def decode(self, v) -> str:
+        """Decode a value encoded by any codec to a JSON string."""
+        if not isinstance(v, bytes):
+            return v
+
+        if v[0] == _ZLIB:
+            return zlib.decompress(v[1:]).decode("utf8")
+        elif v[0] == _ZSTD:
+            return self._zstd_decompressor(v[1:]).decompress(v[1:]).decode("utf8")
+        raise ValueError("unknown encoding of value: {}".format(v[0]))
+
+    def _zstd_decompressor(self, frame):
+        if not zstandard:
+            raise ValueError("the DB is compressed with zstd: pip install zstandard")
+
+        id = zstandard.get_frame_parameters(frame).dict_id
+        if id not in self._decompressors:
+            if id and id not in self._dicts:
+                raise ValueError("unknown zstd dictionary: {}".format(id))
+            d = zstandard.ZstdCompressionDict(self._dicts[id]) if id else None
+            self._decompressors[id] = zstandard.ZstdDecompressor(dict_data=d)
+        return self._decompressors[id]
+
+
+def train_dict(samples) -> (int, bytes):
+    """
+    Train a zstd dictionary on a sample of JSON strings and return its ID
+    and data.
+    """
+    d = zstandard.train_dictionary(
+        ZSTD_DICT_SIZE, [s.encode("utf8") for s in samples]
+    )
+    return d.dict_id(), d.as_bytes()
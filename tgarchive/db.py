@@ -1,12 +1,19 @@
 import json
+import logging
 import math
+import mimetypes
 import os
 import sqlite3
+import time
 from collections import namedtuple
+from collections.abc import Mapping
 from datetime import datetime
 import pytz
-from typing import Iterator
-import shutil
+from typing import Iterator, List, Tuple
+from urllib.request import pathname2url
+
+from .backup import backup, crc32
+from .codec import Codec, train_dict
 
 
 schema = """
@@ -64,6 +71,110 @@ CREATE table media (
 );
 """
 
+# Schema migrations applied in order to new and existing databases.
+# The number of applied migrations is stored in PRAGMA user_version.
+migrations = [
+    # Indexes for month range queries and yyyy-mm month groups.
+    """
+CREATE INDEX idx_messages_date ON messages (date, id);
+##
+CREATE INDEX idx_messages_month ON messages (substr(date, 1, 7));
+##
+CREATE INDEX idx_messages_chat_id ON messages (chat_id, id);
+""",
+    # Index for per-chat month range queries.
+    """
+CREATE INDEX idx_messages_chat_date ON messages (chat_id, date, id);
+""",
+    # Media downloads that failed and are to be retried.
+    """
+CREATE table media_queue (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    dc_id INTEGER,
+    size INTEGER,
+    mime TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (chat_id, message_id)
+);
+""",
+    # Download priority of queued media.
+    """
+ALTER TABLE media_queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;
+##
+CREATE INDEX idx_media_queue_order ON media_queue (chat_id, priority DESC, size);
+""",
+    # Content-addressed media store.
+    """
+CREATE table media_files (
+    file_id INTEGER NOT NULL PRIMARY KEY,
+    hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER
+);
+##
+CREATE INDEX idx_media_files_hash ON media_files (hash);
+""",
+    # Trained dictionaries of the zstd codec of the full columns.
+    """
+CREATE table codec_dicts (
+    id INTEGER NOT NULL PRIMARY KEY,
+    data BLOB NOT NULL
+);
+""",
+    # Full-text search index of message contents, backed by the messages
+    # table by its rowid. Existing messages are indexed by the rebuild.
+    """
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    content, content='messages', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+##
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+""",
+    # Mime type and size of downloaded media files.
+    """
+ALTER TABLE media ADD COLUMN mime TEXT;
+##
+ALTER TABLE media ADD COLUMN size INTEGER;
+""",
+    # Training order of the zstd dictionaries. The newest one is used for
+    # compressing.
+    """
+ALTER TABLE codec_dicts ADD COLUMN seq INTEGER NOT NULL DEFAULT 0;
+""",
+    # Media queued by metadata-only syncs, which only --sync-media downloads.
+    """
+ALTER TABLE media_queue ADD COLUMN deferred BOOLEAN NOT NULL DEFAULT 0;
+""",
+]
+
+# JSON columns that are encoded with the DB's codec.
+full_columns = [
+    ("messages", "full"),
+    ("users", "full"),
+    ("media", "full"),
+    ("chats", "full_dialog"),
+    ("chats", "full_entity"),
+]
+
+# PRAGMAs applied to a connection by its profile.
+profiles = {
+    # Sync writes batches. In WAL mode, readers (builds) and the writer
+    # don't block each other, and NORMAL only fsyncs on checkpoints
+    # while still keeping the DB safe from corruption.
+    "sync": ["journal_mode = WAL", "synchronous = NORMAL"],
+    # Builds only read. Memory map the DB and use a large page cache.
+    "build": [
+        "mmap_size = 1073741824",
+        "cache_size = -131072",
+        "temp_store = MEMORY",
+    ],
+    "default": ["journal_mode = WAL"],
+}
+
 Chat = namedtuple(
     "Chat",
     [
@@ -104,58 +215,346 @@ Message = namedtuple(
     ],
 )
 
+# mime and size are of the downloaded file.
 Media = namedtuple(
-    "Media", ["id", "type", "url", "title", "description", "thumb", "full"]
+    "Media",
+    ["id", "type", "url", "title", "description", "thumb", "full", "mime", "size"],
+    defaults=(None, None),
+)
+
+# Deferred jobs are only downloaded by sync_media(), not retried by syncs.
+MediaJob = namedtuple(
+    "MediaJob",
+    [
+        "chat_id",
+        "message_id",
+        "type",
+        "dc_id",
+        "size",
+        "mime",
+        "attempts",
+        "priority",
+        "deferred",
+    ],
+    defaults=(False,),
 )
 
 Month = namedtuple("Month", ["date", "slug", "label", "count"])
 
 Day = namedtuple("Day", ["date", "slug", "label", "count", "page"])
 
+MonthStats = namedtuple(
+    "MonthStats",
+    ["slug", "count", "first_id", "last_id", "max_edit_date", "checksum"],
+)
+
+
+class LazyJSON(Mapping):
+    """
+    LazyJSON is a read-only dict of a JSON object that's only decoded when
+    it's first accessed. Templates only use a few of the fields of the
+    `full` blobs of rows, and most blobs are never accessed at all.
+    The optional decode function decodes the raw value to JSON first.
+    """
+
+    __slots__ = ("_raw", "_data", "_decoder")
+
+    def __init__(self, raw, decode=None):
+        self._raw = raw
+        self._data = None
+        self._decoder = decode
+
+    @property
+    def raw(self):
+        """The raw (possibly encoded) value."""
+        return self._raw
+
+    def _decode(self) -> dict:
+        if self._data is None:
+            raw = self._decoder(self._raw) if self._decoder else self._raw
+            self._data = json.loads(raw)
+        return self._data
+
+    def __getitem__(self, key):
+        return self._decode()[key]
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __eq__(self, other):
+        return self._decode() == other
+
+    def __repr__(self):
+        return repr(self._decode())
+
+    __str__ = __repr__
+
 
 def _page(n, multiple):
     return math.ceil(n / multiple)
 
 
+def _chat_filter(chat_id, col="chat_id") -> (str, tuple):
+    """
+    Returns the SQL condition and its arguments to limit a messages
+    query to a chat, or to match all chats if chat_id is None.
+    """
+    if chat_id is None:
+        return "1 = 1", ()
+    return "{} = ?".format(col), (chat_id,)
+
+
+def _month_range(year, month) -> (str, str):
+    """
+    Returns the [start, end) date range of a month to query
+    the indexed messages.date column with.
+    """
+    start = "{}-{:02d}-01 00:00:00".format(year, month)
+    if month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    return start, "{}-{:02d}-01 00:00:00".format(year, month)
+
+
+_INSERT_USER = """INSERT INTO users (id, username, first_name, last_name, tags, avatar, full)
+VALUES(?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id)
+DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
+    last_name=excluded.last_name, tags=excluded.tags, avatar=excluded.avatar, full=excluded.full
+"""
+
+_INSERT_MEDIA = """INSERT OR REPLACE INTO media
+(id, type, url, title, description, thumb, full, mime, size)
+VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+_INSERT_MESSAGE = """INSERT OR REPLACE INTO messages
+(id, type, date, edit_date, content, reply_to, user_id, media_id, full, chat_id, from_chat_id)
+VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Columns of a message and its media, in the order _make_message() reads them.
+_MESSAGE_COLUMNS = """messages.id, messages.type, messages.date, messages.edit_date,
+messages.content, messages.reply_to, messages.user_id,
+media.id, media.type, media.url, media.title, media.description, media.thumb,
+media.mime, media.size, media.full as media_full, messages.full as message_full,
+messages.chat_id, messages.from_chat_id"""
+
+# Selects the (rowid, content) of a list of (id, chat_id) message keys
+# given as the rows of a VALUES list.
+_SELECT_MESSAGE_FTS = """SELECT messages.rowid, content FROM (VALUES {}) AS keys
+JOIN messages ON (messages.id = keys.column1 AND messages.chat_id = keys.column2)
+WHERE content IS NOT NULL"""
+
+# Max number of message keys in one _SELECT_MESSAGE_FTS query. SQLite
+# before 3.32 allows at most 999 parameters.
+_FTS_KEYS_LIMIT = 400
+
+
+def _user_row(u: User, encode) -> tuple:
+    return (
+        u.id,
+        u.username,
+        u.first_name,
+        u.last_name,
+        " ".join(u.tags),
+        u.avatar,
+        encode(u.full),
+    )
+
+
+def _media_row(m: Media, encode) -> tuple:
+    return (
+        m.id,
+        m.type,
+        m.url,
+        m.title,
+        m.description,
+        m.thumb,
+        encode(m.full),
+        m.mime,
+        m.size,
+    )
+
+
+def _message_row(m: Message, encode) -> tuple:
+    return (
+        m.id,
+        m.type,
+        m.date.strftime("%Y-%m-%d %H:%M:%S"),
+        m.edit_date.strftime("%Y-%m-%d %H:%M:%S") if m.edit_date else None,
+        m.content,
+        m.reply_to,
+        m.user.id if m.user else None,
+        m.media.id if m.media else None,
+        encode(m.full),
+        m.chat_id,
+        m.from_chat_id,
+    )
+
+
 class DB:
     conn = None
     tz = None
 
-    def __init__(self, dbfile, tz=None, config=None, sync=None):
+    def __init__(
+        self, dbfile, tz=None, config=None, sync=None, readonly=False, profile=None
+    ):
         # Initialize the SQLite DB. If it's new, create the table schema.
         is_new = not os.path.isfile(dbfile)
+        self.dbfile = dbfile
+        self.readonly = readonly
+
+        # Records buffered by buffer_message() until the next flush().
+        self._users = {}
+        self._media = {}
+        self._messages = []
+        self._jobs = []
+
+        # Users and chat entities by ID, loaded once and shared by all
+        # the messages read. Reset on writes.
+        self._user_cache = None
+        self._chat_cache = None
 
         if sync and (not is_new) and config.get("database_backup_dir"):
-            # make backup for dbfile
-            backup_dir = config.get("database_backup_dir")
-            backup_name = datetime.now().isoformat().replace(":", "_").replace(".", "_")
-            backup_path = os.path.join(backup_dir, backup_name)
-            os.makedirs(backup_path, exist_ok=True)
-            new_backup = shutil.copyfile(
+            backup(
                 dbfile,
-                os.path.join(backup_path, dbfile),
+                config["database_backup_dir"],
+                config.get("database_backup_keep", 0),
             )
-            res = shutil.make_archive(backup_path, "zip", backup_path)
-            if res:
-                shutil.rmtree(backup_path)
 
-        self.conn = sqlite3.Connection(
-            dbfile,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-        )
+        if readonly:
+            # Read-only connection for build processes that share the DB.
+            self.conn = sqlite3.Connection(
+                "file:{}?mode=ro".format(pathname2url(os.path.abspath(dbfile))),
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                uri=True,
+            )
+        else:
+            self.conn = sqlite3.Connection(
+                dbfile,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            )
 
         # Add the custom PAGE() function to get the page number of a row
         # by its row number and a limit multiple.
         self.conn.create_function("PAGE", 2, _page)
 
+        # CRC32() is summed per month to get a cheap, order independent
+        # checksum of the month's messages for incremental builds.
+        self.conn.create_function("CRC32", 1, crc32, deterministic=True)
+
         if tz:
             self.tz = pytz.timezone(tz)
 
+        # Apply the connection's profile. Read-only connections are used
+        # by builds.
+        if not profile:
+            profile = "sync" if sync else "build" if readonly else "default"
+        for p in profiles[profile]:
+            self.conn.execute("PRAGMA {}".format(p))
+
+        # Read-only connections only decode the full columns.
+        codec = (config or {}).get("database_compression", "")
+        if readonly:
+            self.codec = self._load_codec("")
+            return
+
         if is_new:
             for s in schema.split("##"):
                 self.conn.cursor().execute(s)
                 self.conn.commit()
 
+        self._migrate()
+        self.codec = self._load_codec(codec)
+
+    def _migrate(self):
+        """Apply pending schema migrations."""
+        cur = self.conn.cursor()
+        (version,) = cur.execute("PRAGMA user_version").fetchone()
+
+        for n, m in enumerate(migrations[version:], version + 1):
+            for s in m.split("##"):
+                cur.execute(s)
+            cur.execute("PRAGMA user_version = {}".format(n))
+            self.conn.commit()
+
+    def _load_codec(self, name) -> Codec:
+        """Make the codec of the full columns with the DB's dictionaries."""
+        try:
+            dicts = dict(
+                self.conn.execute("SELECT id, data FROM codec_dicts ORDER BY seq, rowid")
+            )
+        except sqlite3.OperationalError:
+            # A DB that's not migrated yet.
+            dicts = {}
+        return Codec(name, dicts)
+
+    def recompress(self, batch_size=1000):
+        """
+        Re-encode the full columns of all rows with the DB's codec. For
+        zstd, a new dictionary is trained on a sample of messages first.
+        The DB is vacuumed at the end to reclaim the freed space.
+        """
+        if self.codec.name == "zstd":
+            cur = self.conn.execute(
+                "SELECT full FROM messages ORDER BY RANDOM() LIMIT 10000"
+            )
+            samples = [self.codec.decode(r[0]) for r in cur]
+            try:
+                id, data = train_dict(samples)
+                with self.conn:
+                    self.conn.execute(
+                        """INSERT OR REPLACE INTO codec_dicts (id, data, seq)
+                        VALUES(?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM codec_dicts))""",
+                        (id, data),
+                    )
+                self.codec = self._load_codec("zstd")
+                logging.info("trained zstd dictionary {}".format(id))
+            except Exception as e:
+                logging.info("not using a zstd dictionary: {}".format(e))
+
+        size = os.path.getsize(self.dbfile)
+        for table, col in full_columns:
+            # Rowids can be negative, eg: the IDs of groups and channels.
+            n = 0
+            last = -(2**63)
+            while True:
+                rows = self.conn.execute(
+                    "SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?".format(
+                        col, table
+                    ),
+                    (last, batch_size),
+                ).fetchall()
+                if not rows:
+                    break
+
+                with self.conn:
+                    self.conn.executemany(
+                        "UPDATE {} SET {} = ? WHERE rowid = ?".format(table, col),
+                        [
+                            (self.codec.encode(self.codec.decode(v)), rowid)
+                            for rowid, v in rows
+                        ],
+                    )
+                last = rows[-1][0]
+                n += len(rows)
+            logging.info("encoded {} rows of {}.{}".format(n, table, col))
+
+        self.conn.execute("VACUUM")
+
+        # VACUUM may renumber the rowids of messages that the search index
+        # refers to.
+        with self.conn:
+            self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logging.info(
+            "DB size {:.1f} MB -> {:.1f} MB".format(
+                size / 1e6, os.path.getsize(self.dbfile) / 1e6
+            )
+        )
+
     def _parse_date(self, d) -> str:
         return datetime.strptime(d, "%Y-%m-%dT%H:%M:%S%z")
 
@@ -178,133 +577,276 @@ class DB:
         id, date = res
         return id, date
 
-    def get_timeline(self) -> Iterator[Month]:
+    def get_calendar(
+        self, limit=500, chat_id=None
+    ) -> Iterator[Tuple[Month, List[Day]]]:
         """
-        Get the list of all unique yyyy-mm month groups and
-        the corresponding message counts per period in chronological order.
+        Get all yyyy-mm months in chronological order with the list of
+        their days, message counts and the page number of the first message
+        of every day, paginating the messages of the month in (date, id)
+        order. This is an index only query. Optionally limited to the
+        messages of one chat.
+
+        Months are the UTC months that messages are stored and queried by.
+        With a timezone, the days of a month are the local days of its
+        messages, counted from minute buckets as timezones may be offset
+        by fractions of an hour.
         """
+        chat, args = _chat_filter(chat_id)
+        size = 16 if self.tz else 10
+
         cur = self.conn.cursor()
         cur.execute(
             """
-            SELECT strftime('%Y-%m-%d 00:00:00', date) as "[timestamp]",
-            COUNT(*) FROM messages AS count
-            GROUP BY strftime('%Y-%m', date) ORDER BY date
-        """
+            SELECT substr(date, 1, {size}), COUNT(*) FROM messages WHERE {chat}
+            GROUP BY substr(date, 1, {size}) ORDER BY substr(date, 1, {size})
+        """.format(
+                size=size, chat=chat
+            ),
+            args,
         )
 
-        for r in cur.fetchall():
-            date = pytz.utc.localize(r[0])
-            if self.tz:
-                date = date.astimezone(self.tz)
-
-            yield Month(
-                date=date,
-                slug=date.strftime("%Y-%m"),
-                label=date.strftime("%b %Y"),
-                count=r[1],
+        key, days, n = None, [], 0
+        for bucket, count in cur:
+            if bucket[:7] != key:
+                if days:
+                    yield self._make_month(key, days), days
+                key, days, n = bucket[:7], [], 0
+
+            date = self._localize(
+                datetime.strptime(bucket, "%Y-%m-%d %H:%M" if self.tz else "%Y-%m-%d")
             )
+            slug = date.strftime("%Y-%m-%d")
+            if days and days[-1].slug == slug:
+                days[-1] = days[-1]._replace(count=days[-1].count + count)
+            else:
+                days.append(
+                    Day(
+                        date=date,
+                        slug=slug,
+                        label=date.strftime("%d %b %Y"),
+                        count=count,
+                        page=_page(n + 1, limit),
+                    )
+                )
+            n += count
+
+        if days:
+            yield self._make_month(key, days), days
 
-    def get_dayline(self, year, month, limit=500) -> Iterator[Day]:
+    def _make_month(self, key, days) -> Month:
+        date = pytz.utc.localize(datetime.strptime(key, "%Y-%m"))
+        return Month(
+            date=date,
+            slug=key,
+            label=date.strftime("%b %Y"),
+            count=sum(d.count for d in days),
+        )
+
+    def iter_messages(
+        self, year=None, month=None, chat_id=None
+    ) -> Iterator[Message]:
         """
-        Get the list of all unique yyyy-mm-dd days corresponding
-        message counts and the page number of the first occurrence of
-        the date in the pool of messages for the whole month.
+        Stream all messages in (date, id) order with a single cursor,
+        optionally starting from the given month and limited to one chat.
         """
+        start = _month_range(year, month)[0] if year else ""
+        chat, args = _chat_filter(chat_id, "messages.chat_id")
+
         cur = self.conn.cursor()
         cur.execute(
             """
-            SELECT strftime("%Y-%m-%d 00:00:00", date) AS "[timestamp]",
-            COUNT(*), PAGE(rank, ?) FROM (
-                SELECT ROW_NUMBER() OVER() as rank, date FROM messages
-                WHERE strftime('%Y%m', date) = ? ORDER BY id
-            )
-            GROUP BY "[timestamp]";
-        """,
-            (limit, "{}{:02d}".format(year, month)),
+            SELECT {}
+            FROM messages
+            LEFT JOIN media ON (media.id = messages.media_id)
+            WHERE messages.date >= ? AND {}
+            ORDER by messages.date, messages.id
+            """.format(
+                _MESSAGE_COLUMNS, chat
+            ),
+            (start, *args),
         )
 
-        for r in cur.fetchall():
-            date = pytz.utc.localize(r[0])
-            if self.tz:
-                date = date.astimezone(self.tz)
-
-            yield Day(
-                date=date,
-                slug=date.strftime("%Y-%m-%d"),
-                label=date.strftime("%d %b %Y"),
-                count=r[1],
-                page=r[2],
-            )
+        for r in cur:
+            yield self._make_message(r)
 
-    def get_messages(self, year, month, last_id=0, limit=500) -> Iterator[Message]:
-        date = "{}{:02d}".format(year, month)
+    def get_latest_messages(self, limit, chat_id=None) -> Iterator[Message]:
+        """
+        Get the latest messages in (date, id) descending order, optionally
+        limited to one chat, with a single query on the date indexes.
+        """
+        chat, args = _chat_filter(chat_id, "messages.chat_id")
 
         cur = self.conn.cursor()
         cur.execute(
             """
-            SELECT messages.id, messages.type, messages.date, messages.edit_date,
-            messages.content, messages.reply_to, messages.user_id,
-            users.username, users.first_name, users.last_name, users.tags, users.avatar,
-            media.id, media.type, media.url, media.title, media.description, media.thumb,
-            users.full as user_full, media.full as media_full, messages.full as message_full,
-            messages.chat_id, messages.from_chat_id, chats.full_entity as chat_full_entity
+            SELECT {}
             FROM messages
-            LEFT JOIN users ON (users.id = messages.user_id)
             LEFT JOIN media ON (media.id = messages.media_id)
-            LEFT JOIN chats ON (chats.id = messages.from_chat_id OR chats.id = printf('-100%d', messages.from_chat_id))
-            WHERE strftime('%Y%m', messages.date) = ?
-            AND messages.id > ? ORDER by messages.id LIMIT ?
-            """,
-            (date, last_id, limit),
+            WHERE {}
+            ORDER by messages.date DESC, messages.id DESC LIMIT ?
+            """.format(
+                _MESSAGE_COLUMNS, chat
+            ),
+            (*args, limit),
         )
 
-        for r in cur.fetchall():
+        for r in cur:
             yield self._make_message(r)
 
-    def get_message_count(self, year, month) -> int:
-        date = "{}{:02d}".format(year, month)
+    def get_page_index(
+        self, limit=500, chat_id=None
+    ) -> Iterator[Tuple[int, int, int, int]]:
+        """
+        Get the (chat_id, id, month, page) of all messages in (chat_id, id)
+        order, where month is the 1-based position of the message's month
+        in the timeline and page is the page of the month it is on,
+        paginating the messages of the month in (date, id) order.
+        Optionally limited to the messages of one chat.
+        """
+        chat, args = _chat_filter(chat_id)
 
         cur = self.conn.cursor()
         cur.execute(
             """
-            SELECT COUNT(*) FROM messages WHERE strftime('%Y%m', date) = ?
-            """,
-            (date,),
+            SELECT chat_id, id, DENSE_RANK() OVER (ORDER BY substr(date, 1, 7)),
+            PAGE(ROW_NUMBER() OVER (
+                PARTITION BY substr(date, 1, 7) ORDER BY date, id
+            ), ?)
+            FROM messages WHERE {} ORDER BY chat_id, id
+        """.format(
+                chat
+            ),
+            (limit, *args),
         )
 
-        (total,) = cur.fetchone()
-        return total
+        yield from cur
+
+    def get_month_stats(self, chat_id=None) -> Iterator[MonthStats]:
+        """
+        Get the message id range, the last edit date and a checksum of
+        the contents of every yyyy-mm month group. Used by incremental
+        builds to find months that have changed since the last build.
+        The checksum includes the downloaded files of the media, which
+        are filled in after their messages are synced, and the names and
+        avatars of the users, which change independently of their messages.
+        """
+        chat, args = _chat_filter(chat_id, "messages.chat_id")
 
-    def insert_user(self, u: User):
-        """Insert a user and if they exist, update the fields."""
         cur = self.conn.cursor()
         cur.execute(
-            """INSERT INTO users (id, username, first_name, last_name, tags, avatar, full)
-            VALUES(?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id)
-            DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
-                last_name=excluded.last_name, tags=excluded.tags, avatar=excluded.avatar, full=excluded.full
-            """,
-            (
-                u.id,
-                u.username,
-                u.first_name,
-                u.last_name,
-                " ".join(u.tags),
-                u.avatar,
-                u.full,
+            """
+            SELECT substr(date, 1, 7), COUNT(*), MIN(messages.id), MAX(messages.id),
+            MAX(edit_date), SUM(CRC32(printf('%d:%s:%s:%s:%s:%s:%s:%s:%s',
+                messages.id, date, edit_date, content, reply_to, media_id,
+                media.url, media.thumb, media.mime))
+                + CRC32(printf('%s:%s:%s:%s:%s',
+                users.username, users.first_name, users.last_name, users.tags,
+                users.avatar))
+                + CRC32(messages.full))
+            FROM messages
+            LEFT JOIN media ON (media.id = messages.media_id)
+            LEFT JOIN users ON (users.id = messages.user_id)
+            WHERE {}
+            GROUP BY substr(date, 1, 7)
+        """.format(
+                chat
             ),
+            args,
         )
 
-    def insert_media(self, m: Media):
+        for r in cur:
+            yield MonthStats(
+                slug=r[0],
+                count=r[1],
+                first_id=r[2],
+                last_id=r[3],
+                max_edit_date=r[4],
+                checksum=r[5],
+            )
+
+    def search(self, query, limit=50, chat_id=None) -> Iterator[Tuple[Message, str]]:
+        """
+        Search the contents of messages with an FTS5 query and get the best
+        matching messages with a snippet of their content that highlights
+        the matched terms in [brackets].
+        """
+        chat, args = _chat_filter(chat_id, "messages.chat_id")
+
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT {},
+            snippet(messages_fts, 0, '[', ']', '...', 16)
+            FROM messages_fts
+            JOIN messages ON (messages.rowid = messages_fts.rowid)
+            LEFT JOIN media ON (media.id = messages.media_id)
+            WHERE messages_fts MATCH ? AND {}
+            ORDER BY messages_fts.rank LIMIT ?
+            """.format(
+                _MESSAGE_COLUMNS, chat
+            ),
+            (query, *args, limit),
+        )
+
+        for r in cur.fetchall():
+            yield self._make_message(r[:-1]), r[-1]
+
+    def get_search_docs(
+        self, chat_id=None
+    ) -> Iterator[Tuple[int, int, int, datetime, str]]:
+        """
+        Get the (rowid, chat_id, id, date, content) of all messages with
+        content in (date, id) order, optionally limited to one chat.
+        """
+        chat, args = _chat_filter(chat_id)
+
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT rowid, chat_id, id, date, content FROM messages
+            WHERE content != '' AND {} ORDER BY date, id
+            """.format(
+                chat
+            ),
+            args,
+        )
+
+        for r in cur:
+            yield r[0], r[1], r[2], self._localize(r[3]), r[4]
+
+    def get_search_terms(self) -> Iterator[Tuple[str, int]]:
+        """
+        Get the distinct (term, message rowid) pairs of the search index
+        in term order, read from an fts5vocab table of the index.
+        """
         cur = self.conn.cursor()
         cur.execute(
-            """INSERT OR REPLACE INTO media
-            (id, type, url, title, description, thumb, full)
-            VALUES(?, ?, ?, ?, ?, ?, ?)""",
-            (m.id, m.type, m.url, m.title, m.description, m.thumb, m.full),
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS temp.messages_fts_vocab
+            USING fts5vocab(main, messages_fts, instance)
+            """
         )
+        cur.execute("SELECT term, doc FROM temp.messages_fts_vocab")
+
+        last = None
+        for r in cur:
+            if r != last:
+                yield r
+                last = r
+
+    def insert_user(self, u: User):
+        """Insert a user and if they exist, update the fields."""
+        self._user_cache = None
+        cur = self.conn.cursor()
+        cur.execute(_INSERT_USER, _user_row(u, self.codec.encode))
+
+    def insert_media(self, m: Media):
+        cur = self.conn.cursor()
+        cur.execute(_INSERT_MEDIA, _media_row(m, self.codec.encode))
 
     def insert_chat(self, chat: Chat):
+        self._chat_cache = None
         cur = self.conn.cursor()
         cur.execute(
             """INSERT OR REPLACE INTO chats
@@ -320,39 +862,231 @@ class DB:
                 chat.is_group,
                 chat.is_user,
                 chat.pinned,
-                chat.full_dialog,
-                chat.full_entity,
+                self.codec.encode(chat.full_dialog),
+                self.codec.encode(chat.full_entity),
                 chat.username,
             ),
         )
 
     def insert_message(self, m: Message):
+        self._write_messages(self.conn.cursor(), [m])
+
+    def buffer_message(self, m: Message, job: MediaJob = None):
+        """
+        Buffer a message and its user and media to be written with flush().
+        Users and media are de-duplicated in the buffer by their ID. The
+        optional media job of the message is saved to the media queue with
+        it, so that its download is resumed if the sync is interrupted.
+        """
+        if m.user:
+            self._users[m.user.id] = m.user
+        if m.media:
+            self._media[m.media.id] = m.media
+        if job:
+            self._jobs.append(job)
+        self._messages.append(m)
+
+    def flush(self) -> int:
+        """
+        Write all buffered messages, users, media and media jobs with
+        executemany() in a single transaction and return the number of
+        messages written.
+        """
+        if not self._messages and not self._users and not self._media:
+            return 0
+
+        start = time.monotonic()
+        self._user_cache = None
+        users, media, messages = self._users, self._media, self._messages
+        jobs = self._jobs
+        self._users, self._media, self._messages, self._jobs = {}, {}, [], []
+
+        with self.conn:
+            cur = self.conn.cursor()
+            enc = self.codec.encode
+            cur.executemany(_INSERT_USER, [_user_row(u, enc) for u in users.values()])
+            cur.executemany(_INSERT_MEDIA, [_media_row(m, enc) for m in media.values()])
+            self._write_messages(cur, messages)
+            self._queue_media_jobs(cur, jobs)
+
+        rows = len(users) + len(media) + len(messages)
+        secs = max(time.monotonic() - start, 1e-6)
+        logging.info(
+            "wrote {} messages, {} users, {} media in {:.3f}s ({:.0f} rows/sec)".format(
+                len(messages), len(users), len(media), secs, rows / secs
+            )
+        )
+        return len(messages)
+
+    def _write_messages(self, cur, messages: List[Message]):
+        """
+        Insert or replace messages and update the search index. A replaced
+        message gets a new rowid, so the index entry of the old row is
+        deleted (with its old content) before the new row is indexed.
+        """
+        keys = list(dict.fromkeys((m.id, m.chat_id) for m in messages))
+        cur.executemany(
+            "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', ?, ?)",
+            self._get_fts_rows(keys),
+        )
+
+        enc = self.codec.encode
+        cur.executemany(_INSERT_MESSAGE, [_message_row(m, enc) for m in messages])
+        cur.executemany(
+            "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+            self._get_fts_rows(keys),
+        )
+
+    def _get_fts_rows(self, keys) -> list:
+        """Get the (rowid, content) of the messages to (un)index by their keys."""
+        cur = self.conn.cursor()
+        rows = []
+        for i in range(0, len(keys), _FTS_KEYS_LIMIT):
+            chunk = keys[i : i + _FTS_KEYS_LIMIT]
+            cur.execute(
+                _SELECT_MESSAGE_FTS.format(", ".join(["(?, ?)"] * len(chunk))),
+                [v for k in chunk for v in k],
+            )
+            rows.extend(cur.fetchall())
+        return rows
+
+    def update_media_file(self, job: MediaJob, path):
+        """
+        Set the downloaded file of a media record with its mime type and
+        size and remove its job from the media queue.
+        """
+        with self.conn:
+            cur = self.conn.cursor()
+            if job.type == "webpage":
+                cur.execute(
+                    "UPDATE media SET thumb = ? WHERE id = ?", (path, job.message_id)
+                )
+            else:
+                mime = job.mime or (mimetypes.guess_type(path)[0] if path else None)
+                size = os.path.getsize(path) if path and os.path.isfile(path) else None
+                cur.execute(
+                    """UPDATE media SET url = ?, title = ?, thumb = ?, mime = ?, size = ?
+                    WHERE id = ?""",
+                    (path, path, path, mime, size, job.message_id),
+                )
+            cur.execute(
+                "DELETE FROM media_queue WHERE chat_id = ? AND message_id = ?",
+                (job.chat_id, job.message_id),
+            )
+
+    def update_media_meta(self, media_id, mime, size):
+        """Set the mime type and size of a media record's file."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE media SET mime = ?, size = ? WHERE id = ?", (mime, size, media_id)
+            )
+
+    def queue_media_jobs(self, jobs: List[MediaJob]):
+        """
+        Save media jobs to the media queue to be downloaded later. Jobs
+        that are already queued keep their attempts.
+        """
+        with self.conn:
+            self._queue_media_jobs(self.conn.cursor(), jobs)
+
+    def _queue_media_jobs(self, cur, jobs: List[MediaJob]):
+        cur.executemany(
+            """INSERT INTO media_queue
+            (chat_id, message_id, type, dc_id, size, mime, attempts, priority, deferred)
+            VALUES(?, ?, ?, ?, ?, ?, 0, ?, ?) ON CONFLICT (chat_id, message_id)
+            DO UPDATE SET type=excluded.type, dc_id=excluded.dc_id,
+                size=excluded.size, mime=excluded.mime, priority=excluded.priority,
+                deferred=excluded.deferred""",
+            [
+                (
+                    j.chat_id,
+                    j.message_id,
+                    j.type,
+                    j.dc_id,
+                    j.size,
+                    j.mime,
+                    j.priority,
+                    j.deferred,
+                )
+                for j in jobs
+            ],
+        )
+
+    def save_media_job(self, job: MediaJob, error=None):
+        """
+        Save a failed media job to the media queue to be retried. If it's
+        already queued, its attempts are incremented.
+        """
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO media_queue
+                (chat_id, message_id, type, dc_id, size, mime, attempts, error, priority)
+                VALUES(?, ?, ?, ?, ?, ?, 1, ?, ?) ON CONFLICT (chat_id, message_id)
+                DO UPDATE SET attempts=attempts + 1, error=excluded.error""",
+                (
+                    job.chat_id,
+                    job.message_id,
+                    job.type,
+                    job.dc_id,
+                    job.size,
+                    job.mime,
+                    str(error) if error else None,
+                    job.priority,
+                ),
+            )
+
+    def get_media_jobs(
+        self, chat_id, max_attempts=0, deferred=True
+    ) -> Iterator[MediaJob]:
+        """
+        Get the queued media jobs of a chat in the order of their priority
+        and size, smallest first, excluding the ones that have failed
+        max_attempts times if it's > 0. Deferred jobs are excluded unless
+        deferred is set.
+        """
         cur = self.conn.cursor()
         cur.execute(
-            """INSERT OR REPLACE INTO messages
-            (id, type, date, edit_date, content, reply_to, user_id, media_id, full, chat_id, from_chat_id)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                m.id,
-                m.type,
-                m.date.strftime("%Y-%m-%d %H:%M:%S"),
-                m.edit_date.strftime("%Y-%m-%d %H:%M:%S") if m.edit_date else None,
-                m.content,
-                m.reply_to,
-                m.user.id if m.user else None,
-                m.media.id if m.media else None,
-                m.full,
-                m.chat_id,
-                m.from_chat_id,
-            ),
+            """SELECT chat_id, message_id, type, dc_id, size, mime, attempts, priority,
+            deferred
+            FROM media_queue WHERE chat_id = ? AND (? = 0 OR attempts < ?)
+            AND (? OR NOT deferred)
+            ORDER BY priority DESC, size IS NULL, size, message_id""",
+            (chat_id, max_attempts, max_attempts, deferred),
         )
+        for r in cur.fetchall():
+            yield MediaJob(*r)
+
+    def get_media_file(self, file_id=None, hash=None) -> str:
+        """
+        Get the path of a file in the media store by its Telegram
+        file ID or its hash.
+        """
+        if file_id is not None:
+            q, arg = "file_id = ?", file_id
+        else:
+            q, arg = "hash = ?", hash
+
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT path FROM media_files WHERE {} LIMIT 1".format(q), (arg,)
+        )
+        r = cur.fetchone()
+        return r[0] if r else None
+
+    def insert_media_file(self, file_id, hash, path, size):
+        with self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO media_files (file_id, hash, path, size)
+                VALUES(?, ?, ?, ?)""",
+                (file_id, hash, path, size),
+            )
 
     def commit(self):
         """Commit pending writes to the DB."""
         self.conn.commit()
 
     def _make_message(self, m) -> Message:
-        """Makes a Message() object from an SQL result tuple."""
+        """Makes a Message() object from an SQL result tuple of _MESSAGE_COLUMNS."""
         (
             id,
             typ,
@@ -361,27 +1095,24 @@ class DB:
             content,
             reply_to,
             user_id,
-            username,
-            first_name,
-            last_name,
-            tags,
-            avatar,
             media_id,
             media_type,
             media_url,
             media_title,
             media_description,
             media_thumb,
-            user_full,
+            media_mime,
+            media_size,
             media_full,
             message_full,
             chat_id,
             from_chat_id,
-            chat_full_entity,
         ) = m
 
+        # Files that haven't been downloaded yet have no url. Their
+        # messages are shown without media until they are.
         media = None
-        if media_id:
+        if media_id and (media_url or media_type != "photo"):
             desc = media_description
             if media_type == "poll":
                 desc = json.loads(media_description)
@@ -393,39 +1124,107 @@ class DB:
                 title=media_title,
                 description=desc,
                 thumb=media_thumb,
-                full=json.loads(media_full) if media_full else None,
+                mime=media_mime,
+                size=media_size,
+                full=LazyJSON(media_full, self.codec.decode) if media_full else None,
             )
 
-        date = pytz.utc.localize(date) if date else None
-        edit_date = pytz.utc.localize(edit_date) if edit_date else None
-
-        if self.tz:
-            date = date.astimezone(self.tz) if date else None
-            edit_date = edit_date.astimezone(self.tz) if edit_date else None
-
         return Message(
             id=id,
             type=typ,
-            date=date,
-            edit_date=edit_date,
+            date=self._localize(date),
+            edit_date=self._localize(edit_date),
             content=content,
             reply_to=reply_to,
-            user=User(
-                id=user_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                tags=tags,
-                avatar=avatar,
-                full=json.loads(user_full) if user_full else None,
-            ),
+            user=self._get_user(user_id),
             media=media,
-            full=json.loads(message_full) if message_full else None,
+            full=LazyJSON(message_full, self.codec.decode) if message_full else None,
             chat_id=chat_id,
             from_chat_id=from_chat_id,
-            from_chat=json.loads(chat_full_entity) if chat_full_entity else None,
+            from_chat=self._get_chat_entity(from_chat_id),
         )
 
+    def _localize(self, date) -> datetime:
+        """Localize a UTC date from the DB to the DB's timezone."""
+        if not date:
+            return None
+
+        date = pytz.utc.localize(date)
+        return date.astimezone(self.tz) if self.tz else date
+
+    def _get_user(self, user_id) -> User:
+        """Get a user from the user cache, loading all users on first use."""
+        if self._user_cache is None:
+            self._user_cache = {}
+            cur = self.conn.cursor()
+            cur.execute(
+                """SELECT id, username, first_name, last_name, tags, avatar, full
+                FROM users"""
+            )
+            for id, username, first_name, last_name, tags, avatar, full in cur:
+                self._user_cache[id] = User(
+                    id=id,
+                    username=username,
+                    first_name=first_name,
+                    last_name=last_name,
+                    tags=tags,
+                    avatar=avatar,
+                    full=LazyJSON(full, self.codec.decode) if full else None,
+                )
+
+        u = self._user_cache.get(user_id)
+        if not u:
+            # The message has no user or the user isn't in the DB.
+            u = User(
+                id=user_id,
+                username=None,
+                first_name=None,
+                last_name=None,
+                tags=None,
+                avatar=None,
+                full=None,
+            )
+            self._user_cache[user_id] = u
+        return u
+
+    def _get_chat_entity(self, chat_id):
+        """
+        Get the entity of a chat from the chat cache, loading all chats on
+        first use. Chats are matched by their bare ID or their marked
+        channel ID, -100ID.
+        """
+        if chat_id is None:
+            return None
+
+        if self._chat_cache is None:
+            self._chat_cache = {}
+            cur = self.conn.cursor()
+            cur.execute("SELECT id, full_entity FROM chats")
+            for id, full in cur:
+                if full:
+                    self._chat_cache[id] = LazyJSON(full, self.codec.decode)
+
+        c = self._chat_cache.get(chat_id)
+        if c is None:
+            c = self._chat_cache.get(int("-100{}".format(chat_id)))
+        return c
+
+    def get_chat_ids(self) -> List[int]:
+        """Get the IDs of all chats that have messages."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT DISTINCT chat_id FROM messages ORDER BY chat_id")
+        return [r[0] for r in cur]
+
+    def get_chat(self, chat_id) -> Chat:
+        """
+        Get the chat of the messages with the given chat_id. Messages store
+        the bare entity ID while dialogs are stored with their marked ID,
+        -ID for groups and -100ID for channels.
+        """
+        for c in self.get_groups([chat_id, -chat_id, int("-100{}".format(chat_id))]):
+            return c
+        return None
+
     def get_groups(self, ids) -> Iterator[Chat]:
         cur = self.conn.cursor()
         placeholders = ", ".join(["?"] * len(ids))
@@ -440,7 +1239,7 @@ class DB:
             x = dict_factory(cur, row)
             for json_key in ["full_dialog", "full_entity"]:
                 if json_key in x and x[json_key]:
-                    x[json_key] = json.loads(x[json_key])
+                    x[json_key] = LazyJSON(x[json_key], self.codec.decode)
 
             yield Chat(**x)
             # yield Chat(
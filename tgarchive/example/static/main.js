@@ -7,6 +7,19 @@
 		};
 	});
 
+	// Update the month counts in the timeline, which are only as recent as
+	// the build that rendered the page, from the latest build.
+	const counts = document.querySelectorAll(".timeline .count[data-month]");
+	if (counts.length > 0) {
+		fetch("timeline.json").then((r) => r.ok ? r.json() : {}).then((months) => {
+			counts.forEach((el) => {
+				if (months[el.dataset.month] !== undefined) {
+					el.textContent = `(${months[el.dataset.month]})`;
+				}
+			});
+		}).catch(() => {});
+	}
+
 	// Change page anchor on scrolling past days.
 	let is = null;
 	document.onscroll = () => {
@@ -15,6 +28,9 @@
 		}
 		is = window.setTimeout(() => {
 			const days = document.querySelectorAll(".messages .day");
+			if (days.length === 0) {
+				return;
+			}
 			let lastID = days[0].id;
 			days.forEach((el) => {
 				if (el.getBoundingClientRect().top < 10) {
@@ -34,4 +50,283 @@
 			}
 		}, 100);
 	};
+
+	// Render the messages of a page that's published as JSON (page_format:
+	// json) in batches, as the end of the rendered messages is scrolled into
+	// view. The browser skips the layout of off-screen messages.
+	const batchSize = 50;
+	const list = document.querySelector(".messages[data-page]");
+
+	const esc = (s) => String(s ?? "").replace(/[&<>"']/g, (c) => `&#${c.charCodeAt(0)};`);
+
+	// Escape text, link URLs and break lines like nl2br() and urlize.
+	const formatText = (s) => esc(s).
+		replace(/https?:\/\/[^\s<]+[^\s<.,:;!?)\]]/g, (u) => `<a href="${u}" rel="noopener">${u}</a>`).
+		replace(/\n\n+/g, "\n\n").replace(/\n/g, "<br />");
+
+	const renderDay = (slug, day) => `<li class="day" id="${slug}">
+		<span class="title">${esc(day.title)} <span class="count">(${day.count} messages)</span></span></li>`;
+
+	const renderMedia = (m, md) => {
+		let out = "";
+		const link = `<a href="${esc(md.url)}">${esc(md.title)}</a>`;
+
+		if (md.type === "webpage") {
+			if (md.site_name) {
+				out += `<div class="meta"><span class="username">${esc(md.site_name)}</span></div>`;
+			}
+			out += `<a href="${esc(md.url)}" rel="noreferer nopener nofollow">${esc(md.title)}</a><br/>`;
+			if (md.description) {
+				out += `<p>${esc(md.description)}</p>`;
+			}
+			if (md.thumb) {
+				out += `<a href="${esc(md.url)}" rel="noreferer nopener nofollow"><img class="thumb" src="${esc(md.thumb)}"/></a>`;
+			}
+		} else if (md.type === "poll") {
+			const total = md.description.reduce((n, o) => n + o.count, 0);
+			out += `<div class="poll"><h4 class="title">${esc(md.title)}</h4>
+				<span class="total-count">${total} vote(s).</span><ul class="options">`;
+			md.description.forEach((o) => {
+				out += `<li><span class="count">${o.percent}%, ${o.count} votes</span>
+					<span class="bar" style="width: ${o.percent}%"></span><label>${esc(o.label)}</label></li>`;
+			});
+			out += "</ul></div>";
+		} else if (md.type === "photo" && md.url) {
+			const ext = md.url.split("/").pop().split(".").pop();
+			if (["mp4", "webm", "ogg", "ogv", "mov"].includes(ext)) {
+				out += `<video controls=""><source src="${esc(md.url)}"></source></video><p>${link}</p>`;
+			} else if (ext === "webp") {
+				out += `<a href="${esc(md.url)}"><img class="media-webp" src="${esc(md.url)}"/></a>`;
+			} else if (md.thumb) {
+				out += `<a href="${esc(md.url)}"><img class="thumb" src="${esc(md.thumb)}"/><br/>
+					<span class="filename">${esc(md.title)}</span></a>`;
+			} else {
+				out += link;
+			}
+		} else if (md.type !== "photo") {
+			out += link;
+		}
+
+		let meta = "";
+		if (m.views || m.replies) {
+			meta += `<span class="username"></span>`;
+		}
+		if (m.views) {
+			meta += `<span class="date">views ${m.views}</span>`;
+		}
+		if (m.replies) {
+			meta += `<span class="date">replies ${m.replies}</span>`;
+		}
+		return `<div class="media">${out}<div class="meta">${meta}</div></div>`;
+	};
+
+	const renderMessage = (m, data) => {
+		const u = data.users[m.user] || {};
+		const cfg = data.config;
+		const anchor = `${m.chat_id}:${m.id}`;
+
+		const name = cfg.show_sender_fullname ?
+			`${u.first_name || ""} ${u.last_name || ""}` : `@${u.username || ""}`;
+		let meta = `<a href="${esc(cfg.telegram_url.replace("{id}", u.username))}" rel="noreferer nopener nofollow">${esc(name)}</a>`;
+		if (m.owner) {
+			meta += `<span class="username">owner</span>`;
+		}
+		if (m.reply_to) {
+			const reply = `↶ Reply to #${m.reply_to}`;
+			meta += m.reply_page ?
+				`<a class="reply" href="${esc(m.reply_page)}#${m.chat_id}:${m.reply_to}">${reply}</a>` :
+				`<span class="reply">${reply}</span>`;
+		}
+		meta += `<a class="id" href="#${anchor}">${anchor}</a>`;
+		(u.tags || []).forEach((t) => {
+			meta += `<span class="tags">${esc(t)}</span>`;
+		});
+		meta += `<span class="date">${esc(m.date)}</span>`;
+
+		let fwd = "";
+		if (m.fwd) {
+			const f = m.fwd;
+			fwd = `<div class="meta"><span class="username">Forwarded messages</span></div>
+				<div class="meta"><span class="username"><a href="https://t.me/${esc(f.username)}">${esc(f.title)}</a>
+				(${esc(f.username)})</span>
+				<a class="id" href="#${f.channel_id}:${f.post}">${f.channel_id}:${f.post}</a>
+				<span class="date">${esc(f.date)}</span></div>`;
+		}
+
+		let text = "";
+		const a = m.action || {};
+		if (m.type === "message") {
+			text = m.content ? formatText(m.content) : `${a._ ? esc(a._) + "<br/>" : ""}${esc(m.raw)}`;
+		} else if (m.type === "user_joined") {
+			if (m.from_user_id) {
+				text += `User ${m.from_user_id} invited to join `;
+			}
+			if (a.users) {
+				text += `(${esc(a._)}) ${esc(a.users.join(","))}`;
+			}
+		} else if (m.type === "user_left") {
+			text = `Left ${a.user_id ? esc(a._) + " " + a.user_id : ""}`;
+		}
+		if (m.edit_date) {
+			text += `<div class="meta"><span class="count" style="text-align: center; flex: 1;">Edited ${esc(m.edit_date)}</span></div>`;
+		}
+
+		return `<li class="message type-${esc(m.type)}" id="${anchor}">
+			<div class="avatar">${u.avatar ? `<img alt="" src="${esc(u.avatar)}"/>` : ""}</div>
+			<div class="body"><div class="meta">${meta}</div>${fwd}<div class="text">${text}</div>
+			${m.media ? renderMedia(m, data.media[m.media]) : ""}</div></li>`;
+	};
+
+	const renderPage = async () => {
+		const data = await (await fetch(list.dataset.page)).json();
+
+		// Latest messages first.
+		const messages = data.messages.reverse();
+		const end = document.createElement("li");
+		list.append(end);
+
+		let n = 0;
+		const more = () => {
+			let html = "";
+			for (const stop = Math.min(n + batchSize, messages.length); n < stop; n++) {
+				const m = messages[n];
+				if (n === 0 || m.day !== messages[n - 1].day) {
+					html += renderDay(m.day, data.days[m.day]);
+				}
+				html += renderMessage(m, data);
+			}
+			end.insertAdjacentHTML("beforebegin", html);
+		};
+
+		const fill = () => {
+			while (n < messages.length && end.getBoundingClientRect().top < window.innerHeight * 2) {
+				more();
+			}
+			if (n >= messages.length) {
+				observer.disconnect();
+				end.remove();
+			}
+		};
+		const observer = new IntersectionObserver(fill, { rootMargin: "100% 0px" });
+
+		// Render up to the message or day in the page's anchor.
+		const id = decodeURIComponent(location.hash.substring(1));
+		if (id && messages.some((m) => m.day === id || `${m.chat_id}:${m.id}` === id)) {
+			while (!document.getElementById(id)) {
+				more();
+			}
+			document.getElementById(id).scrollIntoView();
+		}
+
+		fill();
+		if (n < messages.length) {
+			observer.observe(end);
+		}
+	};
+
+	if (list) {
+		renderPage();
+	}
+
+	// Search the static search index in search/. Terms are sharded by their
+	// prefix and messages are in chunks, which are only fetched when a
+	// query needs them.
+	const search = document.querySelector("#search");
+	if (!search) {
+		return;
+	}
+	const results = document.querySelector(".search .results");
+	const maxResults = 50;
+	const files = {};
+	let seq = 0;
+
+	const get = (name) => {
+		if (!files[name]) {
+			files[name] = fetch(`search/${name}.json`).then((r) => r.ok ? r.json() : {});
+		}
+		return files[name];
+	};
+
+	// Split a query into terms like the index's unicode61 tokenizer.
+	const tokenize = (q) => q.normalize("NFD").replace(/\p{M}/gu, "").toLowerCase().
+		split(/[^\p{L}\p{N}]+/u).filter((t) => t);
+
+	const hex = (s) => Array.from(new TextEncoder().encode(s),
+		(b) => b.toString(16).padStart(2, "0")).join("");
+
+	// Get the numbers of the messages a term occurs in. The last term of
+	// a query matches all the terms it is a prefix of. Terms shorter than
+	// the shard prefix only match exactly, as the terms they are a prefix
+	// of are spread over many shards.
+	const lookup = async (meta, term, isPrefix) => {
+		const chars = Array.from(term);
+		const shard = await get(`t/${hex(chars.slice(0, meta.prefix).join(""))}`);
+		if (!isPrefix || chars.length < meta.prefix) {
+			return shard[term] || [];
+		}
+
+		const ids = new Set();
+		for (const t in shard) {
+			if (t.startsWith(term)) {
+				shard[t].forEach((id) => ids.add(id));
+			}
+		}
+		return [...ids];
+	};
+
+	const find = async (q) => {
+		const meta = await get("meta");
+		const terms = tokenize(q);
+
+		let ids = null;
+		for (let i = 0; i < terms.length; i++) {
+			const found = new Set(await lookup(meta, terms[i], i === terms.length - 1));
+			ids = ids === null ? [...found] : ids.filter((id) => found.has(id));
+		}
+
+		// Latest messages first.
+		ids = (ids || []).sort((a, b) => b - a).slice(0, maxResults);
+		return Promise.all(ids.map(async (id) =>
+			(await get(`d/${Math.floor(id / meta.chunk)}`))[id % meta.chunk]));
+	};
+
+	const show = (items) => {
+		results.innerHTML = "";
+		items.forEach(([page, anchor, date, text]) => {
+			const li = document.createElement("li");
+			const a = document.createElement("a");
+			a.href = `${page}#${anchor}`;
+			a.textContent = date;
+			a.onclick = () => {
+				burger.checked = false;
+			};
+
+			const p = document.createElement("p");
+			p.textContent = text;
+			li.append(a, p);
+			results.append(li);
+		});
+
+		if (items.length === 0 && search.value.trim()) {
+			const li = document.createElement("li");
+			li.textContent = "No messages found.";
+			results.append(li);
+		}
+	};
+
+	let t = null;
+	search.oninput = () => {
+		window.clearTimeout(t);
+		t = window.setTimeout(async () => {
+			// Ignore the results of queries that have been typed over.
+			const n = ++seq;
+			const items = await find(search.value);
+			if (n === seq) {
+				show(items);
+			}
+		}, 200);
+	};
+	search.form.onsubmit = (e) => {
+		e.preventDefault();
+	};
 })();
@@ -0,0 +1,136 @@
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from xml.sax.saxutils import escape, quoteattr
+
+
+class FeedWriter:
+    """
+    FeedWriter writes an RSS 2.0 and an Atom feed at the same time, one
+    entry at a time as entries are added, instead of building the feeds
+    in memory. The files are written to temporary files that replace the
+    feeds when the writer is closed.
+
+        with FeedWriter(rss_file, atom_file, url, title, description, gen) as f:
+            f.add(url, title, date, content, enclosure)
+    """
+
+    def __init__(self, rss_file, atom_file, url, title, description, generator):
+        self.rss_file = rss_file
+        self.atom_file = atom_file
+        self._rss = open(rss_file + ".tmp", "w", encoding="utf8")
+        self._atom = open(atom_file + ".tmp", "w", encoding="utf8")
+
+        now = datetime.now(timezone.utc)
+        self._rss.write(
+            """<?xml version='1.0' encoding='UTF-8'?>
+<rss xmlns:atom="http://www.w3.org/2005/Atom" version="2.0">
+  <channel>
+    <title>{title}</title>
+    <link>{url}</link>
+    <description>{description}</description>
+    <docs>http://www.rssboard.org/rss-specification</docs>
+    <generator>{generator}</generator>
+    <lastBuildDate>{date}</lastBuildDate>
+""".format(
+                title=escape(title),
+                url=escape(url),
+                description=escape(description),
+                generator=escape(generator),
+                date=format_datetime(now),
+            )
+        )
+        self._atom.write(
+            """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <id>{url}</id>
+  <title>{title}</title>
+  <updated>{date}</updated>
+  <link href={url_attr} rel="alternate"/>
+  <generator>{generator}</generator>
+  <subtitle>{description}</subtitle>
+""".format(
+                title=escape(title),
+                url=escape(url),
+                url_attr=quoteattr(url),
+                description=escape(description),
+                generator=escape(generator),
+                date=now.isoformat(),
+            )
+        )
+
+    def add(self, url, title, date, content, enclosure=None):
+        """
+        Write an entry to the feeds. date is a timezone aware datetime and
+        content is HTML. enclosure is an optional (url, size, mime) of the
+        entry's media file.
+        """
+        rss_enc, atom_enc = "", ""
+        if enclosure:
+            u, size, mime = quoteattr(enclosure[0]), enclosure[1] or 0, enclosure[2]
+            rss_enc = "\n      <enclosure url={} length=\"{}\" type={}/>".format(
+                u, size, quoteattr(mime)
+            )
+            atom_enc = (
+                '\n    <link href={} rel="enclosure" type={} length="{}"/>'.format(
+                    u, quoteattr(mime), size
+                )
+            )
+
+        self._rss.write(
+            """    <item>
+      <title>{title}</title>
+      <link>{url}</link>
+      <description>{content}</description>
+      <guid isPermaLink="false">{url}</guid>{enclosure}
+      <pubDate>{date}</pubDate>
+    </item>
+""".format(
+                title=escape(title),
+                url=escape(url),
+                content=escape(content),
+                enclosure=rss_enc,
+                date=format_datetime(date),
+            )
+        )
+        self._atom.write(
+            """  <entry>
+    <id>{url}</id>
+    <title>{title}</title>
+    <updated>{date}</updated>
+    <content type="html">{content}</content>
+    <link href={url_attr} rel="alternate"/>{enclosure}
+    <published>{date}</published>
+  </entry>
+""".format(
+                title=escape(title),
+                url=escape(url),
+                url_attr=quoteattr(url),
+                content=escape(content),
+                enclosure=atom_enc,
+                date=date.isoformat(),
+            )
+        )
+
+    def close(self):
+        """Finish the feeds and replace the feed files with them."""
+        self._rss.write("  </channel>\n</rss>\n")
+        self._atom.write("</feed>\n")
+        self._rss.close()
+        self._atom.close()
+        os.replace(self.rss_file + ".tmp", self.rss_file)
+        os.replace(self.atom_file + ".tmp", self.atom_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        if typ is None:
+            self.close()
+            return
+
+        # Keep the previous feeds.
+        self._rss.close()
+        self._atom.close()
+        os.remove(self.rss_file + ".tmp")
+        os.remove(self.atom_file + ".tmp")
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+
+class MediaDownloader:
+    """
+    MediaDownloader downloads media in a bounded pool of concurrent
+    workers. Besides the total number of concurrent downloads, the
+    downloads from every Telegram data center (DC) are limited, as
+    every DC is a separate connection that Telegram rate limits.
+
+    download(job, msg) is a coroutine that downloads the media of a
+    message and returns its path. done(job, path) is called when a
+    download finishes and failed(job, error) when it fails.
+    """
+
+    def __init__(self, download, done, failed, concurrency=4, dc_concurrency=2):
+        self.download = download
+        self.done = done
+        self.failed = failed
+        self.concurrency = max(concurrency, 1)
+        self.dc_concurrency = max(dc_concurrency, 1)
+
+        # Queued jobs are bounded so that fetching messages doesn't
+        # run too far ahead of the downloads.
+        self._queue = asyncio.Queue(self.concurrency * 2)
+        self._dcs = {}
+        self._workers = []
+
+    def start(self):
+        """Start the download workers on the running event loop."""
+        self._workers = [
+            asyncio.ensure_future(self._work()) for _ in range(self.concurrency)
+        ]
+
+    async def put(self, job, msg):
+        """Queue the media of a message to be downloaded."""
+        await self._queue.put((job, msg))
+
+    async def close(self):
+        """Wait for the queued downloads to finish and stop the workers."""
+        for _ in self._workers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._workers)
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+
+            job, msg = item
+            if job.dc_id not in self._dcs:
+                self._dcs[job.dc_id] = asyncio.Semaphore(self.dc_concurrency)
+
+            async with self._dcs[job.dc_id]:
+                logging.info(
+                    "downloading media #{} (dc {})".format(job.message_id, job.dc_id)
+                )
+                try:
+                    path = await self.download(job, msg)
+                except Exception as e:
+                    logging.error(
+                        "error downloading media: #{}: {}".format(job.message_id, e)
+                    )
+                    self.failed(job, e)
+                    continue
+
+            self.done(job, path)
+
+
+class MediaStore:
+    """
+    MediaStore is a content-addressed store of downloaded media files in
+    media_dir/store, keyed by their Telegram photo/document ID and the
+    SHA-256 hash of their contents. Files that are reposted or forwarded
+    are hard linked from the store into the directory of every message
+    instead of being downloaded and stored again.
+    """
+
+    def __init__(self, db, media_dir):
+        self.db = db
+        self.dir = os.path.join(media_dir, "store")
+
+    def get(self, file_id) -> str:
+        """Get the path of a stored file by its Telegram file ID."""
+        path = self.db.get_media_file(file_id=file_id)
+        if path and os.path.exists(path):
+            return path
+        return None
+
+    def put(self, file_id, hash, path) -> str:
+        """
+        Add a downloaded file to the store and return the path to use for
+        it. If a file with the same contents is already stored, the
+        downloaded file is replaced with a link to it.
+        """
+        stored = self.db.get_media_file(hash=hash)
+        if stored and os.path.exists(stored):
+            if not os.path.samefile(stored, path):
+                os.remove(path)
+                path = self.link(stored, path)
+        else:
+            stored = os.path.join(self.dir, hash[:2], hash, os.path.basename(path))
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            try:
+                os.link(path, stored)
+            except OSError:
+                # Without hard links, the downloaded file is the stored one.
+                stored = path
+
+        self.db.insert_media_file(file_id, hash, stored, os.path.getsize(stored))
+        return path
+
+    def link(self, stored, path) -> str:
+        """
+        Hard link a stored file to path and return it. If the file can't
+        be linked, the stored file's path is returned to reference instead.
+        """
+        try:
+            os.link(stored, path)
+            return path
+        except OSError:
+            return stored
+
+
+def hash_file(path) -> str:
+    """Get the SHA-256 hash of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
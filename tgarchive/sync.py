@@ -1,20 +1,24 @@
+from collections import OrderedDict
 from io import BytesIO
 from sys import exit
+import asyncio
 import json
 import logging
 import os
 import tempfile
-import shutil
-import time
 import random
 
 from PIL import Image, ImageDraw, ImageFont
 
 import telethon.tl.types
-from telethon import TelegramClient, errors, sync
+from telethon import TelegramClient, errors
 from telethon.tl.functions.messages import ExportChatInviteRequest
 
-from .db import User, Message, Media, Chat
+from .db import User, Message, Media, MediaJob, Chat
+from .media import MediaDownloader, MediaStore, hash_file
+
+# Max number of resolved users to keep in memory during a sync.
+_USER_CACHE_SIZE = 10000
 
 
 class Sync:
@@ -26,23 +30,83 @@ class Sync:
     config = {}
     db = None
 
-    def __init__(self, config, session_file, db):
+    def __init__(self, config, session_file, db, client=None):
         self.config = config
         self.db = db
 
-        self.client = self.new_client(session_file, config)
+        # The client can be passed in, eg: a fake client in tests.
+        self.client = client if client else self.new_client(session_file, config)
+        self.store = MediaStore(db, self.config["media_dir"])
+
+        # LRU of user ID: ((user ID, photo ID), task resolving the User)
+        # of the users resolved in this run.
+        self._users = OrderedDict()
 
         if not os.path.exists(self.config["media_dir"]):
             os.makedirs(self.config["media_dir"], exist_ok=True)
 
-    def sync(self, ids=None, from_id=None, group=None):
+    def run(self, ids=None, from_id=None, groups=None, metadata_only=False):
+        """
+        Connect the client, save the dialogs and sync all the groups
+        on the client's event loop.
+        """
+        self.client.loop.run_until_complete(
+            self._run(ids, from_id, groups, metadata_only)
+        )
+
+    def run_media(self, groups=None, budget=0):
+        """
+        Connect the client and download the queued media of all the groups
+        on the client's event loop, up to budget bytes (0 for no limit).
+        """
+        self.client.loop.run_until_complete(self._run_media(groups, budget))
+
+    async def _run(self, ids, from_id, groups, metadata_only):
+        await self.start()
+        await self.init_get_and_save_dialogs()
+        for group in groups:
+            await self.sync(ids, from_id, group, metadata_only)
+
+        if self.config.get("use_takeout", False):
+            await self.finish_takeout()
+
+    async def _run_media(self, groups, budget):
+        await self.start()
+        for group in groups:
+            group_id = await self._get_group_id(group)
+            size = await self.sync_media(group_id, budget)
+            if budget > 0:
+                budget -= size
+                if budget <= 0:
+                    logging.info("media download budget exhausted")
+                    break
+
+        if self.config.get("use_takeout", False):
+            await self.finish_takeout()
+
+    async def sync(self, ids=None, from_id=None, group=None, metadata_only=False):
         """
         Sync syncs messages from Telegram from the last synced message
         into the local SQLite DB.
+
+        Fetching messages, downloading their media and avatars and writing
+        them to the DB overlap: a fetch task queues a task per message that
+        downloads its media, and a writer task writes the results to the DB
+        in batches, in the order they were fetched. The queue is bounded
+        by sync_concurrency, the number of messages in flight.
+
+        Media files are downloaded by a separate pool of workers
+        (media_concurrency) that fills in the media records once the
+        messages are written. Media is saved to the media queue with its
+        message and removed when its download finishes, so failed and
+        interrupted downloads are retried on the next sync, alongside the
+        new messages. If metadata_only is set, nothing is downloaded and
+        all media is deferred in the media queue to be downloaded later
+        with sync_media().
         """
 
         logging.info("======== get entity group %s ========", group)
-        group_id = self._get_group_id(group)
+        group_id = await self._get_group_id(group)
 
         logging.info("processing group=%s group_id=%s", group, group_id)
 
@@ -64,68 +128,216 @@ class Sync:
                 )
             )
 
-        n = 0
-        while True:
-            has = False
-            for m in self._get_messages(
-                group_id,
-                offset_id=last_id if last_id else 0,
-                ids=ids,
-            ):
-                if not m:
-                    continue
+        if self.config["download_avatars"] and self.config["prefetch_avatars"]:
+            await self._prefetch_users(group_id)
 
-                has = True
-                # Insert the records into DB.
-                if m.user:
-                    self.db.insert_user(m.user)
+        media, retry = None, None
+        if not metadata_only:
+            media = self._new_media_downloader()
+            media.start()
+            retry = self._retry_media(media, group_id)
 
-                if m.media:
-                    self.db.insert_media(m.media)
+        # The fetch task always queues None when it stops, and its error,
+        # if any, is raised after the messages fetched before it are written.
+        queue = asyncio.Queue(self.config["sync_concurrency"])
+        fetch = asyncio.ensure_future(
+            self._fetch_batches(queue, group_id, last_id, ids)
+        )
+        try:
+            n, last_date = await self._write_messages(queue, group_id, media)
+            await fetch
+            if retry:
+                await retry
+        finally:
+            fetch.cancel()
+            if retry:
+                retry.cancel()
+
+        if media:
+            await media.close()
 
-                self.db.insert_message(m)
+        logging.info(
+            "Finished. for group_id={} fetched total {} messages. last message = {}".format(
+                group_id, n, last_date
+            )
+        )
 
-                last_date = m.date
+    async def _fetch_batches(self, queue, group_id, last_id, ids):
+        """
+        Fetch messages in batches and queue a task per message that
+        makes its Message record, until there are no more messages. None
+        is queued at the end, also when fetching fails.
+        """
+        try:
+            await self._fetch(queue, group_id, last_id, ids)
+        finally:
+            await queue.put(None)
 
-                n += 1
-                if n % 100 == 0:
-                    logging.info(
-                        "for group_id={} fetched {} messages".format(group_id, n)
-                    )
-                    self.db.commit()
-                    time.sleep(random.choice(range(1, 100)) / 50)
-                else:
-                    slp = random.choice(range(1, 100)) / 50
-                    if slp < 0.2:
-                        time.sleep(slp)
+    async def _fetch(self, queue, group_id, last_id, ids):
+        n = 0
+        while True:
+            messages = await self._fetch_messages(
+                group_id, offset_id=last_id if last_id else 0, ids=ids
+            )
+            messages = [m for m in messages if m]
+
+            for m in messages:
+                await queue.put(
+                    asyncio.ensure_future(self._process_message(m, group_id))
+                )
 
-                if 0 < self.config["fetch_limit"] <= n or ids:
-                    has = False
+                n += 1
+                if 0 < self.config["fetch_limit"] <= n:
                     break
 
-            self.db.commit()
+            if not messages or ids or 0 < self.config["fetch_limit"] <= n:
+                break
 
-            if has:
-                last_id = m.id
-                logging.info(
-                    "for group_id={} fetched {} messages. sleeping for {} seconds".format(
-                        group_id, n, self.config["fetch_wait"]
-                    )
+            last_id = messages[-1].id
+            logging.info(
+                "for group_id={} fetched {} messages. sleeping for {} seconds".format(
+                    group_id, n, self.config["fetch_wait"]
                 )
-                time.sleep(self.config["fetch_wait"])
-            else:
+            )
+            await asyncio.sleep(self.config["fetch_wait"])
+
+    async def _write_messages(self, queue, group_id, media) -> (int, object):
+        """
+        Write the messages of the queued tasks to the DB in the order they
+        were fetched, flushing a batch whenever fetch_batch_size messages
+        are buffered or no more messages are ready. The media jobs of
+        the messages are saved to the media queue with them and are
+        queued for download after they are written, so that the downloads
+        can update their media records. Without a downloader, the jobs
+        are deferred.
+        """
+        n = 0
+        buffered = 0
+        last_date = None
+        jobs = []
+        while True:
+            task = await queue.get()
+            if task is None:
                 break
 
-        self.db.commit()
+            m, job = await task
+            if not m:
+                continue
 
-        if self.config.get("use_takeout", False):
-            self.finish_takeout()
+            self.db.buffer_message(
+                m, job[0]._replace(deferred=media is None) if job else None
+            )
+            last_date = m.date
+            if job:
+                jobs.append(job)
+
+            n += 1
+            buffered += 1
+            if n % 100 == 0:
+                logging.info("for group_id={} synced {} messages".format(group_id, n))
+
+            if buffered >= self.config["fetch_batch_size"] or queue.empty():
+                self.db.flush()
+                buffered = 0
+                await self._queue_media(media, jobs)
+                jobs = []
+
+        self.db.flush()
+        await self._queue_media(media, jobs)
+        return n, last_date
+
+    async def _queue_media(self, media, jobs):
+        """
+        Queue written media jobs (MediaJob, message) for download. Without
+        a downloader, they are left in the media queue in the DB.
+        """
+        if media is None:
+            return
+
+        for job, msg in jobs:
+            await media.put(job, msg)
+
+    async def sync_media(self, group_id, budget=0) -> int:
+        """
+        Download the queued media of a group in the order of their priority
+        and size, smallest first, until the total size of the downloads
+        reaches budget bytes (0 for no limit). Finished downloads are
+        removed from the queue as they complete, so an interrupted run
+        resumes where it stopped. Returns the number of bytes queued
+        for download.
+        """
+        jobs = []
+        size = 0
+        for job in self.db.get_media_jobs(
+            group_id, self.config["media_retry_attempts"]
+        ):
+            if budget > 0 and size + (job.size or 0) > budget:
+                break
+            jobs.append(job)
+            size += job.size or 0
 
         logging.info(
-            "Finished. for group_id={} fetched total {} messages. last message = {}".format(
-                group_id, n, last_date
+            "for group_id={} downloading {} queued media ({} bytes)".format(
+                group_id, len(jobs), size
+            )
+        )
+
+        media = self._new_media_downloader()
+        media.start()
+        try:
+            await self._download_jobs(media, group_id, jobs)
+        finally:
+            await media.close()
+        return size
+
+    def _new_media_downloader(self) -> MediaDownloader:
+        return MediaDownloader(
+            lambda job, msg: self._download_media(msg, job.chat_id),
+            self.db.update_media_file,
+            self.db.save_media_job,
+            self.config["media_concurrency"],
+            self.config["media_dc_concurrency"],
+        )
+
+    def _retry_media(self, media, group_id) -> asyncio.Future:
+        """
+        Start a task that queues the queued media downloads of a group that
+        haven't exhausted their media_retry_attempts for download again,
+        concurrently with the new messages. These are the downloads that
+        failed and the ones that were interrupted. Deferred downloads are
+        left to sync_media(). Returns None if there are none.
+        """
+        jobs = list(
+            self.db.get_media_jobs(
+                group_id, self.config["media_retry_attempts"], deferred=False
+            )
+        )
+        if not jobs:
+            return None
+
+        logging.info(
+            "for group_id={} retrying {} queued media downloads".format(
+                group_id, len(jobs)
             )
         )
+        return asyncio.ensure_future(self._download_jobs(media, group_id, jobs))
+
+    async def _download_jobs(self, media, group_id, jobs):
+        """
+        Fetch the messages of saved media jobs and queue them for download.
+        """
+        for i in range(0, len(jobs), 100):
+            batch = jobs[i : i + 100]
+            messages = await self._fetch_messages(
+                group_id, 0, ids=[j.message_id for j in batch]
+            )
+            msgs = {m.id: m for m in messages if m}
+            for job in batch:
+                msg = msgs.get(job.message_id)
+                if msg and msg.media:
+                    await media.put(job, msg)
+                else:
+                    self.db.save_media_job(job, "message or media not found")
 
     def new_client(self, session, config):
         if "proxy" in config and config["proxy"].get("enable"):
@@ -153,17 +365,21 @@ class Sync:
             client_logger._info(*args, **kwargs)
 
         client_logger.info = patched_info
+        return client
 
-        # Start client protocol
-        client.start()
+    async def start(self):
+        """Start the client protocol and initiate takeout if it's enabled."""
+        await self.client.start()
 
-        if config.get("use_takeout", False):
+        if self.config.get("use_takeout", False):
             for retry in range(3):
                 try:
-                    takeout_client = client.takeout(finalize=True)
+                    takeout_client = self.client.takeout(finalize=True)
+                    await takeout_client.__aenter__()
                     # check if the takeout session gets invalidated
-                    takeout_client.get_messages("me")
-                    return takeout_client
+                    await takeout_client.get_messages("me")
+                    self.client = takeout_client
+                    return
                 except errors.TakeoutInitDelayError as e:
                     logging.info(
                         "please allow the data export request received from Telegram on your device. "
@@ -181,91 +397,141 @@ class Sync:
             else:
                 logging.info("could not initiate takeout.")
                 raise (Exception("could not initiate takeout."))
-        else:
-            return client
 
-    def finish_takeout(self):
-        self.client.__exit__(None, None, None)
+    async def finish_takeout(self):
+        await self.client.__aexit__(None, None, None)
 
-    def _get_messages(self, group_id, offset_id, ids=None) -> Message:
-        messages = self._fetch_messages(group_id, offset_id, ids)
+    async def _process_message(self, m, group_id) -> (Message, tuple):
+        """
+        Make the Message record of a Telegram message, downloading the
+        sender's avatar. The media job (MediaJob, message) that downloads
+        the message's media, if any, is returned with it.
+        """
         # https://docs.telethon.dev/en/latest/quick-references/objects-reference.html#message
-        for m in messages:
-            if not m:
-                continue
 
-            # Media.
-            sticker = None
-            med = None
-            if m.media:
-                # If it's a sticker, get the alt value (unicode emoji).
-                if (
-                    isinstance(m.media, telethon.tl.types.MessageMediaDocument)
-                    and hasattr(m.media, "document")
-                    and m.media.document.mime_type == "application/x-tgsticker"
-                ):
-                    alt = [
-                        a.alt
-                        for a in m.media.document.attributes
-                        if isinstance(a, telethon.tl.types.DocumentAttributeSticker)
-                    ]
-                    if len(alt) > 0:
-                        sticker = alt[0]
-                elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
-                    med = self._make_poll(m)
-                else:
-                    med = self._get_media(m, group_id)
-
-            # Message.
-            typ = "message"
-            if m.action:
-                if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
-                    typ = "user_joined"
-                elif isinstance(
-                    m.action, telethon.tl.types.MessageActionChatDeleteUser
-                ):
-                    typ = "user_left"
-
-            yield Message(
-                type=typ,
-                id=m.id,
-                date=m.date,
-                edit_date=m.edit_date,
-                content=sticker if sticker else m.raw_text,
-                reply_to=m.reply_to_msg_id
-                if m.reply_to and m.reply_to.reply_to_msg_id
-                else None,
-                user=self._get_user(m.sender) if m.sender else None,
-                media=med,
-                full=m.to_json(),
-                chat_id=group_id,
-                from_chat_id=(
-                    getattr(m.fwd_from.from_id, "channel_id", None)
-                    if m.fwd_from and m.fwd_from.from_id
-                    else None
-                ),
-                from_chat=None,
-            )
+        # Media.
+        sticker = None
+        med = None
+        job = None
+        if m.media:
+            # If it's a sticker, get the alt value (unicode emoji).
+            if (
+                isinstance(m.media, telethon.tl.types.MessageMediaDocument)
+                and hasattr(m.media, "document")
+                and m.media.document.mime_type == "application/x-tgsticker"
+            ):
+                alt = [
+                    a.alt
+                    for a in m.media.document.attributes
+                    if isinstance(a, telethon.tl.types.DocumentAttributeSticker)
+                ]
+                if len(alt) > 0:
+                    sticker = alt[0]
+            elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
+                med = self._make_poll(m)
+            else:
+                med, job = self._get_media(m, group_id)
+
+        # Message.
+        typ = "message"
+        if m.action:
+            if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
+                typ = "user_joined"
+            elif isinstance(
+                m.action, telethon.tl.types.MessageActionChatDeleteUser
+            ):
+                typ = "user_left"
+
+        msg = Message(
+            type=typ,
+            id=m.id,
+            date=m.date,
+            edit_date=m.edit_date,
+            content=sticker if sticker else m.raw_text,
+            reply_to=m.reply_to_msg_id
+            if m.reply_to and m.reply_to.reply_to_msg_id
+            else None,
+            user=await self._get_user(m.sender) if m.sender else None,
+            media=med,
+            full=m.to_json(),
+            chat_id=group_id,
+            from_chat_id=(
+                getattr(m.fwd_from.from_id, "channel_id", None)
+                if m.fwd_from and m.fwd_from.from_id
+                else None
+            ),
+            from_chat=None,
+        )
+        return msg, job
+
+    async def _fetch_messages(self, group, offset_id, ids=None) -> list:
+        if self.config.get("use_takeout", False):
+            wait_time = 0
+        else:
+            wait_time = None
 
-    def _fetch_messages(self, group, offset_id, ids=None) -> Message:
+        while True:
+            try:
+                messages = await self.client.get_messages(
+                    group,
+                    offset_id=offset_id,
+                    limit=self.config["fetch_batch_size"],
+                    wait_time=wait_time,
+                    ids=ids,
+                    reverse=True,
+                )
+                # A single ID returns a single message.
+                if not isinstance(messages, list):
+                    messages = [messages]
+                return messages
+            except errors.FloodWaitError as e:
+                logging.info("flood waited: have to wait {} seconds".format(e.seconds))
+                await asyncio.sleep(e.seconds)
+
+    async def _get_user(self, u) -> User:
+        """
+        Get the User record of a sender, downloading their avatar. Users
+        are resolved once per run and cached until their photo changes.
+        """
+        key = (u.id, _get_photo_id(u))
+        cached = self._users.get(u.id)
+        if cached and cached[0] == key:
+            self._users.move_to_end(u.id)
+        else:
+            # Cache the task so that concurrent messages from the same
+            # user wait for a single resolution.
+            cached = (key, asyncio.ensure_future(self._make_user(u)))
+            self._users[u.id] = cached
+            if len(self._users) > _USER_CACHE_SIZE:
+                self._users.popitem(last=False)
+
+        return await cached[1]
+
+    async def _prefetch_users(self, group_id):
+        """
+        Resolve and save the users and download the avatars of all the
+        participants of a group concurrently, before syncing its messages.
+        """
         try:
-            if self.config.get("use_takeout", False):
-                wait_time = 0
-            else:
-                wait_time = None
-            messages = self.client.get_messages(
-                group,
-                offset_id=offset_id,
-                limit=self.config["fetch_batch_size"],
-                wait_time=wait_time,
-                ids=ids,
-                reverse=True,
-            )
-            return messages
-        except errors.FloodWaitError as e:
-            logging.info("flood waited: have to wait {} seconds".format(e.seconds))
+            users = [u async for u in self.client.iter_participants(group_id)]
+        except errors.RPCError as e:
+            logging.info("unable to get participants of {}: {}".format(group_id, e))
+            return
 
-    def _get_user(self, u) -> User:
+        logging.info(
+            "prefetching {} users of group_id={}".format(len(users), group_id)
+        )
+        sem = asyncio.Semaphore(self.config["media_concurrency"])
+
+        async def get(u):
+            async with sem:
+                return await self._get_user(u)
+
+        for u in await asyncio.gather(*[get(u) for u in users]):
+            self.db.insert_user(u)
+        self.db.commit()
+
+    async def _make_user(self, u) -> User:
         tags = []
         is_normal_user = isinstance(u, telethon.tl.types.User)
 
@@ -290,11 +556,11 @@ class Sync:
         if u.fake:
             tags.append("fake")
 
-        # Download sender's profile photo if it's not already cached.
+        # Download sender's profile photo if it's not already downloaded.
         avatar = None
         if self.config["download_avatars"]:
             try:
-                fname = self._download_avatar(u)
+                fname = await self._download_avatar(u)
                 avatar = fname
             except Exception as e:
                 logging.error("error downloading avatar: #{}: {}".format(u.id, e))
@@ -335,26 +601,27 @@ class Sync:
             full=msg.media.to_json(),
         )
 
-    def _get_media(self, msg, group_id):
-        res = None
+    def _get_media(self, msg, group_id) -> (Media, tuple):
+        """
+        Make the Media record of a message and the media job
+        (MediaJob, message) that downloads its file, if any. The file
+        fields of the record are filled in when the download finishes.
+        """
         if isinstance(
             msg.media, telethon.tl.types.MessageMediaWebPage
         ) and not isinstance(msg.media.webpage, telethon.tl.types.WebPageEmpty):
-            try:
-                media_file_path = self._download_media(msg, group_id)
-                res = Media(
-                    id=msg.id,
-                    type="webpage",
-                    url=msg.media.webpage.url,
-                    title=msg.media.webpage.title,
-                    description=msg.media.webpage.description
-                    if msg.media.webpage.description
-                    else None,
-                    thumb=media_file_path,
-                    full=msg.media.to_json(),
-                )
-            except Exception as e:
-                logging.error("error downloading media: #{}: {}".format(msg.id, e))
+            res = Media(
+                id=msg.id,
+                type="webpage",
+                url=msg.media.webpage.url,
+                title=msg.media.webpage.title,
+                description=msg.media.webpage.description
+                if msg.media.webpage.description
+                else None,
+                thumb=None,
+                full=msg.media.to_json(),
+            )
+            return res, self._make_media_job(msg, group_id, "webpage")
         elif (
             isinstance(msg.media, telethon.tl.types.MessageMediaPhoto)
             or isinstance(msg.media, telethon.tl.types.MessageMediaDocument)
@@ -374,25 +641,56 @@ class Sync:
                                     msg.file.name, msg.file.mime_type
                                 )
                             )
-                            return
+                            return None, None
 
-                logging.info("downloading media #{}".format(msg.id))
-                try:
-                    media_file_path = self._download_media(msg, group_id)
-                    res = Media(
-                        id=msg.id,
-                        type="photo",
-                        url=media_file_path,
-                        title=media_file_path,
-                        description=None,
-                        thumb=media_file_path,
-                        full=msg.media.to_json(),
-                    )
-                except Exception as e:
-                    logging.error("error downloading media: #{}: {}".format(msg.id, e))
-        return res
+                res = Media(
+                    id=msg.id,
+                    type="photo",
+                    url=None,
+                    title=None,
+                    description=None,
+                    thumb=None,
+                    full=msg.media.to_json(),
+                )
+                return res, self._make_media_job(msg, group_id, "photo")
+        return None, None
+
+    def _make_media_job(self, msg, group_id, typ) -> tuple:
+        media = msg.media
+        if typ == "webpage":
+            media = msg.media.webpage
+
+        # The DC that stores the file. Contacts have no file and
+        # are generated locally.
+        f = getattr(media, "photo", None) or getattr(media, "document", None)
+        if typ == "webpage" and not f:
+            return None
+
+        file = msg.file
+        job = MediaJob(
+            chat_id=group_id,
+            message_id=msg.id,
+            type=typ,
+            dc_id=getattr(f, "dc_id", None),
+            size=file.size if file else None,
+            mime=file.mime_type if file else None,
+            attempts=0,
+            priority=self._get_media_priority(file.mime_type if file else None),
+        )
+        return job, msg
 
-    def _download_media(self, msg, group_id) -> [str, str, str]:
+    def _get_media_priority(self, mime) -> int:
+        """
+        Get the download priority of a mime type from media_priority_mime_types,
+        where the first type (or prefix, eg: image/) has the highest priority.
+        """
+        types = self.config["media_priority_mime_types"]
+        for i, t in enumerate(types):
+            if mime and mime.startswith(t):
+                return len(types) - i
+        return 0
+
+    async def _download_media(self, msg, group_id) -> [str, str, str]:
         media_path = os.path.join(
             self.config["media_dir"],
             "chats",
@@ -403,14 +701,47 @@ class Sync:
         if os.path.exists(media_path):
             present_file = get_first_non_hidden_file(media_path)
             if present_file:
-                return os.path.join(media_path, present_file)
+                present_file = os.path.join(media_path, present_file)
 
-        file_path = self.client.download_media(msg)
-        if file_path:
-            os.makedirs(media_path, exist_ok=True)
-            media_file_path = shutil.move(file_path, media_path)
+                # A document that's smaller than it should be is a download
+                # that was interrupted. Download it again.
+                if (
+                    msg.document
+                    and msg.file.size
+                    and os.path.getsize(present_file) < msg.file.size
+                ):
+                    os.remove(present_file)
+                else:
+                    return present_file
+
+        # If the file was already downloaded for another message, eg: it
+        # was forwarded, link to it from the store.
+        f = msg.photo or msg.document
+        if f:
+            stored = self.store.get(f.id)
+            if stored:
+                os.makedirs(media_path, exist_ok=True)
+                return self.store.link(
+                    stored, os.path.join(media_path, os.path.basename(stored))
+                )
+
+        # Download straight into the message's directory so that concurrent
+        # downloads of files with the same name don't clash.
+        os.makedirs(media_path, exist_ok=True)
+        media_file_path = await self.client.download_media(msg, file=media_path)
+        if not media_file_path:
+            if not os.listdir(media_path):
+                os.rmdir(media_path)
             return media_file_path
 
+        if f:
+            # Hash in a thread to not block the other downloads.
+            h = await asyncio.get_running_loop().run_in_executor(
+                None, hash_file, media_file_path
+            )
+            media_file_path = self.store.put(f.id, h, media_file_path)
+        return media_file_path
+
     def _get_file_ext(self, f) -> str:
         if "." in f:
             e = f.split(".")[-1]
@@ -419,7 +750,10 @@ class Sync:
 
         return ".file"
 
-    def _download_avatar(self, user):
+    async def _download_avatar(self, user):
+        # Avatars are stored by their photo ID so that changed avatars are
+        # downloaded again, and unchanged ones are never refetched.
+        photo_id = _get_photo_id(user)
         media_dir_path = os.path.join(
             self.config["media_dir"],
             "users",
@@ -427,30 +761,33 @@ class Sync:
         )
         media_file_path = os.path.join(
             media_dir_path,
-            f"{user.username}.png",
+            f"{photo_id}.png" if photo_id else "default.png",
         )
 
         if os.path.exists(media_file_path):
             return media_file_path
 
-        photo_file_path = self.client.download_profile_photo(user, file=media_file_path)
+        photo_file_path = await self.client.download_profile_photo(
+            user, file=media_file_path
+        )
         logging.info("download profile photo %s", photo_file_path)
 
         if not photo_file_path:
+            # The user has no (visible) photo. Generate one.
             avatar = generate_avarat(user.first_name[0] if user.first_name else "N")
             os.makedirs(media_dir_path, exist_ok=True)
             avatar.save(media_file_path)
             return media_file_path
         return photo_file_path
 
-    def init_get_and_save_dialogs(self):
+    async def init_get_and_save_dialogs(self):
         # Get all dialogs for the authorized user, which also
         # syncs the entity cache to get latest entities
         # ref: https://docs.telethon.dev/en/latest/concepts/entities.html#getting-entities
 
         logging.info("======== get initial dialogs ========")
 
-        dialogs = self.client.get_dialogs()
+        dialogs = await self.client.get_dialogs()
         for dialog in dialogs:
             chat = Chat(
                 id=dialog.id,
@@ -472,10 +809,10 @@ class Sync:
             self.db.insert_chat(chat)
 
         self.db.commit()
-        time.sleep(random.choice(range(1, 100)) / 70)
+        await asyncio.sleep(random.choice(range(1, 100)) / 70)
         logging.info("saved dialogs %s", len(dialogs))
 
-    def _get_group_id(self, group):
+    async def _get_group_id(self, group):
         """
         Syncs the Entity cache and returns the Entity ID for the specified group,
         which can be a str/int for group ID, group name, or a group username.
@@ -491,7 +828,7 @@ class Sync:
             pass
 
         try:
-            entity = self.client.get_entity(group)
+            entity = await self.client.get_entity(group)
         except ValueError:
             logging.critical(
                 "the group: {} does not exist,"
@@ -503,6 +840,11 @@ class Sync:
         return entity.id
 
 
+def _get_photo_id(user):
+    """Get the ID of a user's or a chat's current profile photo, if any."""
+    return getattr(getattr(user, "photo", None), "photo_id", None)
+
+
 def generate_avarat(one_latter):
     avatar_size = (100, 100)
     # background_color = (255, 0, 255)